@@ -1,60 +1,194 @@
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
 
 from sig_groups.ride import Roster
 from sig_groups.rider import Leader, Participant, Match
+from sig_groups.snapshot import ModifiedSince, SyncStart
+
+# Airtable allows 5 requests per second per base, and at most 10 records in
+# each create, update or delete request.
+REQUESTS_PER_SECOND = 5
+BATCH_SIZE = 10
+MAX_RETRIES = 5
+
+# Fields read by _CreateLeader, _CreateParticipant and GetPriorRosters.  Only
+# these are requested so that pages stay small.
+LEADER_FIELDS = ['Name', 'Gender', 'Availability', 'Scouted', 'Experience']
+PARTICIPANT_FIELDS = ['Name', 'Gender', 'Mentor', 'Status',
+                      'Woman Leader Required', 'Availability']
+ROSTER_FIELDS = ['Ride', 'Group', 'Leaders', 'Participants', 'Finalized']
+
+class RateLimiter(object):
+    '''
+    Spaces out requests shared between threads to at most rate per second.
+    '''
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next = 0
+
+    def Wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
 
 class AirtableClient(object):
-    def __init__(self, airtable_config, ride_config):
+    '''
+    Loads riders and rosters from Airtable and writes rosters back.  With a
+    SnapshotStore tables are synced incrementally into the snapshot, and when
+    offline they are read from it without any requests.
+    '''
+    def __init__(self, airtable_config, ride_config, snapshot=None, offline=False):
         self.base = airtable_config['base']
         self.key = airtable_config['key']
-        logging.info('Initializing Airtable client for base: ', self.base)
+        logging.info('Initializing Airtable client for base: %s', self.base)
 
         self.ride_num = {}
         for r in ride_config:
             self.ride_num[r['airtable_id']] = r['rank']
 
-    def _GetAirtable(self, url_path):
-        url = "https://api.airtable.com/v0/" + self.base + "/" + url_path
-        headers = {'Authorization': 'Bearer ' + self.key}
-        return requests.get(url, headers=headers)
+        # One pooled, keep-alive session for every request, with a connection
+        # for each of WriteRosters' threads.
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = 'Bearer ' + self.key
+        adapter = HTTPAdapter(pool_maxsize=REQUESTS_PER_SECOND)
+        self.session.mount('https://', adapter)
+        self.limiter = RateLimiter(REQUESTS_PER_SECOND)
+        self.records = {}  # map from table -> prefetched records
+        self.snapshot = snapshot
+        self.offline = offline
+        if offline and snapshot is None:
+            raise ValueError('Offline mode needs a snapshot store')
 
-    def _PostAirtable(self,url_path, data):
+    def _Request(self, method, url_path, retry_errors=True, **kwargs):
+        '''
+        Sends a request under the rate limit, retrying with exponential backoff
+        while Airtable answers 429 (rate limited) or, if retry_errors, 5xx.
+        '''
+        if self.offline:
+            raise RuntimeError('Airtable %s %s requested while offline' % (method, url_path))
         url = "https://api.airtable.com/v0/" + self.base + "/" + url_path
-        headers = {'Authorization': 'Bearer ' + self.key,
-                 'Content-Type': 'application/json'}
-        return requests.post(url, headers=headers, json=data)
+        for attempt in range(MAX_RETRIES + 1):
+            self.limiter.Wait()
+            response = self.session.request(method, url, **kwargs)
+            retry = (response.status_code == 429 or
+                     (retry_errors and response.status_code >= 500))
+            if not retry or attempt == MAX_RETRIES:
+                return response
+            # After a 429 Airtable rejects all requests for 30 seconds.
+            backoff = 30 if response.status_code == 429 else 2 ** attempt
+            logging.warning('Airtable %s %s returned %d, retrying in %d s',
+                            method, url_path, response.status_code, backoff)
+            time.sleep(backoff)
+
+    def _GetAirtable(self, url_path, params=None):
+        return self._Request('GET', url_path, params=params)
+
+    def _PostAirtable(self, url_path, data):
+        # A create that failed with a 5xx may still have been committed, and
+        # resending it would duplicate the records.  Rate limited requests are
+        # rejected before they're processed, so those are still retried.
+        return self._Request('POST', url_path, retry_errors=False, json=data)
 
     def _PutAirtable(self, url_path, data):
-        url = "https://api.airtable.com/v0/" + self.base + "/" + url_path
-        headers = {'Authorization': 'Bearer ' + self.key,
-                 'Content-Type': 'application/json'}
-        return requests.put(url, headers=headers, json=data)
+        return self._Request('PUT', url_path, json=data)
 
-    def _DeleteAirtable(self, url_path):
-        url = "https://api.airtable.com/v0/" + self.base + "/" + url_path
-        headers = {'Authorization': 'Bearer ' + self.key,
-                 'Content-Type': 'application/json'}
-        return requests.delete(url, headers=headers)
+    def _DeleteAirtable(self, url_path, params=None):
+        return self._Request('DELETE', url_path, params=params)
+
+    def _ListRecords(self, table, fields=None, formula=None):
+        '''
+        Returns every record in table, or those matching formula, following
+        Airtable's offset pagination.
+        '''
+        records = []
+        params = {'pageSize': 100}
+        if fields:
+            params['fields[]'] = fields
+        if formula:
+            params['filterByFormula'] = formula
+        while True:
+            response = self._GetAirtable(table, params)
+            response.raise_for_status()
+            page = response.json()
+            records.extend(page['records'])
+            if 'offset' not in page:
+                return records
+            params['offset'] = page['offset']
+
+    def _SyncTable(self, table, fields):
+        '''
+        Returns every record in table.  With a snapshot only records modified
+        since the last sync are downloaded in full, along with the ids of all
+        records to drop deleted ones.
+        '''
+        if self.snapshot is None:
+            return self._ListRecords(table, fields)
+        snapshot = self.snapshot.Load(self.base, table)
+        if self.offline:
+            if snapshot is None:
+                raise RuntimeError('No snapshot of %s to run offline from' % table)
+            print('Loaded %d %s from snapshot synced %s' %
+                  (len(snapshot['records']), table, snapshot['synced']))
+            return list(snapshot['records'].values())
+
+        synced = SyncStart()
+        if snapshot is None or snapshot['fields'] != fields:
+            records = self._ListRecords(table, fields)
+            print('Downloaded %d %s' % (len(records), table))
+        else:
+            modified = self._ListRecords(table, fields, ModifiedSince(snapshot['synced']))
+            ids = [r['id'] for r in self._ListRecords(table, fields[:1])]
+            known = snapshot['records']
+            known.update((r['id'], r) for r in modified)
+            records = [known[id] for id in ids if id in known]
+            print('Synced %s: %d modified, %d deleted, %d total' %
+                  (table, len(modified), len(known) - len(records), len(records)))
+        self.snapshot.Save(self.base, table, fields, records, synced)
+        return records
+
+    def _Records(self, table, fields):
+        if table in self.records:
+            return self.records.pop(table)
+        return self._SyncTable(table, fields)
 
-    def _LoadTable(self, table, construct):
+    def Prefetch(self):
+        '''
+        Loads the Leaders, Participants and Rosters tables concurrently, for
+        LoadLeaders, LoadParticipants and GetPriorRosters to consume.
+        '''
+        tables = [('Leaders', LEADER_FIELDS),
+                  ('Participants', PARTICIPANT_FIELDS),
+                  ('Rosters', ROSTER_FIELDS)]
+        with ThreadPoolExecutor(max_workers=len(tables)) as executor:
+            futures = [(t, executor.submit(self._SyncTable, t, f)) for (t, f) in tables]
+            for (table, future) in futures:
+                self.records[table] = future.result()
+
+    def _LoadTable(self, table, construct, fields=None):
       records = []
-      response = self._GetAirtable(table)
-      for record in response.json()['records']:
+      for record in self._Records(table, fields):
         new = construct(record)
         records.append(new)
       return records
 
     def LoadLeaders(self):
-      return self._LoadTable("Leaders", _CreateLeader)
+      return self._LoadTable("Leaders", _CreateLeader, LEADER_FIELDS)
 
     def LoadParticipants(self):
-      return self._LoadTable("Participants", _CreateParticipant)
+      return self._LoadTable("Participants", _CreateParticipant, PARTICIPANT_FIELDS)
 
     def GetPriorRosters(self, rider_data):
       rosters = []
-      response = self._GetAirtable('Rosters')
-      for r in response.json()['records']:
+      for r in self._Records('Rosters', ROSTER_FIELDS):
         id = r['id']
         group = r['fields']['Group']
         ride = self.ride_num[r['fields']['Ride'][0]]
@@ -69,44 +203,91 @@ class AirtableClient(object):
         rosters.append(Roster(rider_data, id, ride, group, rider_ids, finalized))
       return rosters
 
-    def CreateRoster(self, roster, rides):
-      ride_to_id = {}
-      for r in rides:
-        ride_to_id[r.num] = r.airtable_id
-
-      if roster.finalized:
-        print('Skipping finalized roster: ', r.id)
-        return
-      leaders = roster.GetLeaderIds()
-      participants = roster.GetParticipantIds()
-      fields = {
+    def _RosterFields(self, roster, ride_to_id):
+      return {
         'Ride': [ride_to_id[roster.ride]],
         'Group': roster.group,
-        'Leaders': leaders,
-        'Participants': participants,
+        'Leaders': roster.GetLeaderIds(),
+        'Participants': roster.GetParticipantIds(),
       }
-      if roster.id is not None:
-        record = {'id': roster.id, 'fields': fields}
-        print(record)
-        resp = self._PutAirtable('Rosters', { 'records': [record] })
-        print(resp.content)
+
+    def _WriteBatch(self, action, batch, ride_to_id):
+      '''
+      Sends one batch of roster writes and returns whether it succeeded.
+      Created rosters get the ids of their new records.
+      '''
+      if action == 'create':
+        records = [{'fields': self._RosterFields(r, ride_to_id)} for r in batch]
+        resp = self._PostAirtable('Rosters', {'records': records})
+      elif action == 'update':
+        records = [{'id': r.id, 'fields': self._RosterFields(r, ride_to_id)}
+                   for r in batch]
+        resp = self._PutAirtable('Rosters', {'records': records})
       else:
-        record = {'fields': fields}
-        print(record)
-        resp = self._PostAirtable('Rosters', { 'records': [record] })
-        print(resp.content)
+        resp = self._DeleteAirtable('Rosters', {'records[]': [r.id for r in batch]})
+      if not resp.ok:
+        print('Failed to %s rosters %s: %s' % (action,
+              ', '.join('%d.%d' % (r.ride + 1, r.group + 1) for r in batch),
+              resp.content))
+        return False
+      if action == 'create':
+        for (roster, record) in zip(batch, resp.json()['records']):
+          roster.id = record['id']
+      return True
 
-    def DeleteRoster(self, roster, rides):
+    def WriteRosters(self, rosters, deleted, rides):
+      '''
+      Creates or updates rosters and deletes the deleted rosters in batches of
+      BATCH_SIZE records, sent concurrently under the rate limit.  Finalized
+      rosters are skipped.  Returns a summary of the records written.
+      '''
       ride_to_id = {}
       for r in rides:
         ride_to_id[r.num] = r.airtable_id
 
-      if roster.finalized:
-        print('Skipping finalized roster: ', r.id)
-        return
-      assert(len(roster.id) > 0)
-      print('Deleting %s' % roster.id)
-      self._DeleteAirtable('Rosters/%s' % roster.id)
+      writes = {'create': [], 'update': [], 'delete': []}
+      skipped = 0
+      for roster in rosters:
+        if roster.finalized:
+          skipped += 1
+        elif roster.id is None:
+          writes['create'].append(roster)
+        else:
+          writes['update'].append(roster)
+      for roster in deleted:
+        if roster.finalized:
+          skipped += 1
+        else:
+          assert(len(roster.id) > 0)
+          writes['delete'].append(roster)
+
+      batches = []
+      for (action, pending) in writes.items():
+        for i in range(0, len(pending), BATCH_SIZE):
+          batches.append((action, pending[i:i + BATCH_SIZE]))
+      summary = dict((action, 0) for action in writes)
+      summary['failed'] = 0
+      summary['skipped'] = skipped
+      with ThreadPoolExecutor(max_workers=REQUESTS_PER_SECOND) as executor:
+        futures = [(action, batch, executor.submit(self._WriteBatch, action, batch, ride_to_id))
+                   for (action, batch) in batches]
+        for (action, batch, future) in futures:
+          if future.result():
+            summary[action] += len(batch)
+          else:
+            summary['failed'] += len(batch)
+
+      print('Airtable: created %d, updated %d, deleted %d rosters in %d requests '
+            '(%d skipped as finalized, %d failed)' % (summary['create'],
+            summary['update'], summary['delete'], len(batches), skipped,
+            summary['failed']))
+      return summary
+
+    def CreateRoster(self, roster, rides):
+      return self.WriteRosters([roster], [], rides)
+
+    def DeleteRoster(self, roster, rides):
+      return self.WriteRosters([], [roster], rides)
 
 def _LoadAvailability(rider, json):
   if 'Availability' in json['fields']:
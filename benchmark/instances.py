@@ -0,0 +1,135 @@
+import random
+
+from sig_groups.ride import Ride, Roster
+from sig_groups.rider import Leader, Participant, RiderData
+
+class InstanceSpec(object):
+    def __init__(self, name, num_leaders, num_participants, num_rides, seed=0,
+                 finalized_rides=0):
+        self.name = name
+        self.num_leaders = num_leaders
+        self.num_participants = num_participants
+        self.num_rides = num_rides
+        self.seed = seed
+
+        # Fractions of leaders that are experienced and inexperienced, the rest
+        # are new leaders.
+        self.experienced = 0.4
+        self.inexperienced = 0.2
+
+        # Fraction of riders that are women.
+        self.female = 0.5
+
+        # Probability that a rider is available for any given ride.
+        self.availability = 0.8
+
+        # Probability that an available leader scouted a ride.
+        self.scouting = 0.25
+
+        # Fraction of participants with a mentor, and needing a woman leader.
+        self.mentored = 0.2
+        self.woman_leader = 0.05
+
+        # Number of hand curated pair match scores.
+        self.num_matches = 10
+
+        # Number of rides with a together constraint for a few riders.
+        self.num_together = 2
+
+        # Number of rides at the start of the program that already happened.
+        self.finalized_rides = finalized_rides
+
+    def NumRiders(self):
+        return self.num_leaders + self.num_participants
+
+class Instance(object):
+    def __init__(self, spec, rider_data, rides, prior_rosters):
+        self.spec = spec
+        self.rider_data = rider_data
+        self.rides = rides
+        self.prior_rosters = prior_rosters
+
+# Size tiers run by the benchmark, from quick to season scale.  The late tier
+# is the large one late in the season, with most rides finalized.
+TIERS = [
+    InstanceSpec('small', 10, 16, 4, seed=1),
+    InstanceSpec('medium', 18, 30, 6, seed=2),
+    InstanceSpec('large', 28, 45, 10, seed=3),
+    InstanceSpec('late', 28, 45, 10, seed=3, finalized_rides=7),
+]
+
+def _FinalizedRosters(rider_data, ride, num_groups):
+    '''
+    Deals the available riders on a ride into groups, leaders first, so that
+    every group gets leaders.
+    '''
+    riders = sorted(rider_data.AllRiders(), key=lambda x: (not x.IsLeader(), x.id))
+    riders = [p for p in riders if p.IsAvailable(ride)]
+    groups = [[] for _ in range(0, num_groups)]
+    for (i, p) in enumerate(riders):
+        groups[i % num_groups].append(p.id)
+    return [Roster(rider_data, 'rec%d_%d' % (ride, g), ride, g, ids, True)
+            for (g, ids) in enumerate(groups)]
+
+def Generate(spec):
+    '''
+    Returns a synthetic Instance for spec.  The same spec always generates the
+    same instance.
+    '''
+    rnd = random.Random(spec.seed)
+    rides = []
+    for r in range(0, spec.num_rides):
+        rides.append(Ride({'rank': r, 'title': 'Ride %d' % (r + 1),
+                           'airtable_id': 'ride%d' % r,
+                           'slack_channel': 'C%d' % r}))
+
+    def Gender():
+        return 'F' if rnd.random() < spec.female else 'M'
+
+    def Availability(rider):
+        for r in range(0, spec.num_rides):
+            if rnd.random() < spec.availability:
+                rider.SetAvailable(r)
+
+    leaders = []
+    for i in range(0, spec.num_leaders):
+        l = Leader('recL%03d' % i, 'Leader %d' % i)
+        l.gender = Gender()
+        x = rnd.random()
+        if x < spec.experienced:
+            l.type = Leader.Type.EXPERIENCED
+        elif x < spec.experienced + spec.inexperienced:
+            l.type = Leader.Type.INEXPERIENCED
+        Availability(l)
+        for r in range(0, spec.num_rides):
+            # Scouts count towards scouted groups, so only scout rides the
+            # leader is available for.
+            if l.IsAvailable(r) and rnd.random() < spec.scouting:
+                l.scouted.add(rides[r].airtable_id)
+        leaders.append(l)
+
+    participants = []
+    for i in range(0, spec.num_participants):
+        p = Participant('recP%03d' % i, 'Participant %d' % i)
+        p.gender = Gender()
+        Availability(p)
+        if rnd.random() < spec.mentored:
+            p.mentor = rnd.choice(leaders).id
+        if rnd.random() < spec.woman_leader:
+            p.woman_leader_req = True
+        participants.append(p)
+
+    rider_data = RiderData(leaders, participants)
+    ids = [p.id for p in rider_data.AllRiders()]
+    for _ in range(0, spec.num_matches):
+        (p1, p2) = rnd.sample(ids, 2)
+        rider_data.SetMatchScore(p1, p2, rnd.choice([-50, -5, 5]))
+    for r in rnd.sample(range(0, spec.num_rides), min(spec.num_together, spec.num_rides)):
+        rides[r].AddTogetherConstraint(rnd.sample(ids, 2))
+
+    prior_rosters = []
+    for r in range(0, spec.finalized_rides):
+        num_groups = max(1, len([l for l in leaders if l.IsAvailable(r)]) // 3)
+        prior_rosters.extend(_FinalizedRosters(rider_data, r, num_groups))
+
+    return Instance(spec, rider_data, rides, prior_rosters)
@@ -0,0 +1,226 @@
+import argparse
+import contextlib
+import copy
+import datetime
+import io
+import json
+import os
+import time
+
+import yaml
+from ortools import __version__ as ortools_version
+from ortools.sat.python import cp_model
+
+from sig_groups.benchmark.instances import TIERS, Generate
+from sig_groups.optimizer import AlgorithmTM, Params, Printer, Vars
+from sig_groups.profiler import Profiler
+
+class _TimingPrinter(Printer):
+  '''
+  Records when each improving solution was found, and its objective.
+  '''
+  def __init__(self, vars, riders):
+    super().__init__(vars, riders)
+    self.first_solution = None
+    self.trajectory = []
+
+  def on_solution_callback(self):
+    if self.first_solution is None:
+      self.first_solution = self.WallTime()
+    self.trajectory.append((round(self.WallTime(), 3), self.ObjectiveValue()))
+    super().on_solution_callback()
+
+def PassStats(profiler, printers):
+  '''
+  Returns stats for each pass, keyed by the profiler section it ran in (e.g.
+  'pairings', or 'window 0-3/pairings' in a rolling horizon), from the phases
+  recorded by AlgorithmTM.Solve and the _TimingPrinter of each solve in order.
+  '''
+  passes = {}
+  printers = iter(printers)
+  for phase in profiler.phases:
+    stats = passes.setdefault(phase['section'],
+                              {'build_time': 0, 'variables': 0, 'constraints': 0})
+    if phase['phase'] == 'LocalSearch':
+      stats['local_search_time'] = phase['wall_time']
+    elif phase['phase'] == 'Solve':
+      printer = next(printers)
+      feasible = phase['status'] in ('OPTIMAL', 'FEASIBLE')
+      stats.update({
+        'status': phase['status'],
+        'wall_time': phase['wall_time'],
+        'first_feasible': printer.first_solution,
+        'trajectory': printer.trajectory,
+        'objective': phase['objective'] if feasible else None,
+        'bound': phase['bound'] if feasible else None,
+      })
+    else:
+      stats['build_time'] += phase['wall_time']
+      stats['variables'] += phase.get('variables_added', 0)
+      stats['constraints'] += phase.get('constraints_added', 0)
+  return passes
+
+def Evaluate(instance, params, rosters):
+  '''
+  Returns the pass 2 objective of rosters, or None if they break a constraint,
+  so that rosters from any engine or mode can be compared.  The formulation is
+  pinned, since e.g. dense memberships score finalized groups differently.
+  '''
+  params = copy.copy(params)
+  params.horizon = 0
+  params.lookahead_rides = 0
+  params.symmetry_breaking = False
+  params.sparse_memberships = True
+  params.pairing_encoding = 'membership'
+  alg = AlgorithmTM(instance.rider_data, instance.rides, instance.prior_rosters, params)
+  vars = Vars()
+  model = alg.BuildBaseModel(vars)
+  vars.FixMemberships(model, [(roster.ride, roster.group, p)
+                              for roster in rosters for p in roster.rider_ids])
+  alg.OptimizePairings(model, vars)
+  solver = cp_model.CpSolver()
+  status = solver.Solve(model)
+  if status not in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+    return None
+  return solver.ObjectiveValue()
+
+def RunTier(spec, params, verbose=False, workers=8, solver_seed=0):
+  '''
+  Solves the tier's instance.  Unless the solver profiles in params set them,
+  every solve uses workers workers and solver_seed as its random seed, so that
+  results don't depend on the number of CPUs of the machine.
+  '''
+  instance = Generate(spec)
+  params = copy.copy(params)
+  params.num_rides = spec.num_rides
+  params.start_ride = spec.finalized_rides
+  params.finalized_ride = spec.finalized_rides - 1
+
+  result = {
+    'tier': spec.name,
+    'seed': spec.seed,
+    'riders': len(instance.rider_data.AllRiders()),
+    'rides': spec.num_rides,
+  }
+  pinned = {'num_workers': workers, 'random_seed': solver_seed}
+  if not verbose:
+    pinned['log_search_progress'] = False
+  params.group_size_solver = dict(pinned, **params.group_size_solver)
+  params.pairings_solver = dict(pinned, **params.pairings_solver)
+  result['workers'] = {'group_size': params.group_size_solver['num_workers'],
+                       'pairings': params.pairings_solver['num_workers']}
+
+  printers = []
+  def NewPrinter(vars, riders):
+    printer = _TimingPrinter(vars, riders)
+    printers.append(printer)
+    return printer
+
+  quiet = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+  with quiet:
+    start = time.time()
+    profiler = Profiler()
+    alg = AlgorithmTM(instance.rider_data, instance.rides, instance.prior_rosters, params,
+                      profiler=profiler, printer=NewPrinter)
+    rosters = alg.Solve()
+    result['total_time'] = time.time() - start
+    result['passes'] = PassStats(profiler, printers)
+    result['objective'] = None
+    if rosters is not None:
+      result['objective'] = Evaluate(instance, params, rosters)
+  result['feasible'] = result['objective'] is not None
+  return result
+
+def TimeToQuality(stats, objective):
+  '''
+  Returns the wall time at which a pass first reached objective, or None.
+  '''
+  for (t, value) in stats.get('trajectory', []):
+    if value >= objective:
+      return t
+  return None
+
+def Compare(results, baseline):
+  '''
+  Prints objectives, pass 2 model sizes and, for tiers where both runs found a
+  solution, how long each pass 2 took to reach the worse final objective.
+  '''
+  old = dict((r['tier'], r) for r in baseline['results'])
+  print('%-10s %12s %12s %10s %10s %12s %12s %10s %10s' % (
+        'tier', 'objective', 'baseline', 'time', 'baseline', 'variables', 'baseline',
+        'to match', 'baseline'))
+  for r in results['results']:
+    if r['tier'] not in old:
+      continue
+    b = old[r['tier']]
+    new_pass = r['passes'].get('pairings', {})
+    old_pass = b['passes'].get('pairings', {})
+    to_match = [None, None]
+    if new_pass.get('objective') is not None and old_pass.get('objective') is not None:
+      target = min(new_pass['objective'], old_pass['objective'])
+      to_match = [TimeToQuality(new_pass, target), TimeToQuality(old_pass, target)]
+    print('%-10s %12s %12s %10.1f %10.1f %12s %12s %10s %10s' % (
+          r['tier'], r['objective'], b['objective'], r['total_time'], b['total_time'],
+          new_pass.get('variables'), old_pass.get('variables'), *to_match))
+
+def ParseParam(params, setting):
+  (name, value) = setting.split('=', 1)
+  if not hasattr(params, name):
+    raise ValueError('Unknown parameter: %s' % name)
+  setattr(params, name, yaml.safe_load(value))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(prog='sig_groups.benchmark.run',
+      description='Runs TheAlgorithm™ on synthetic instances of increasing size '
+                  'and records model sizes, solve times and objectives.')
+  parser.add_argument('-t', '--tiers', nargs='*',
+    default=[s.name for s in TIERS], choices=[s.name for s in TIERS],
+    help='Size tiers to run.')
+  parser.add_argument('-l', '--time-limit', type=float, default=10,
+    help='Solver time limit per pass, in seconds.')
+  parser.add_argument('-p', '--param', action='append', default=[],
+    help='Override a Params attribute, e.g. --param symmetry_breaking=true.')
+  parser.add_argument('-o', '--output', default='benchmark.json',
+    help='Path to write the JSON results to.')
+  parser.add_argument('-c', '--compare',
+    help='Path to earlier JSON results to compare against.')
+  parser.add_argument('-w', '--workers', type=int, default=8,
+    help='CP-SAT workers for every solve, unless a solver profile sets num_workers.')
+  parser.add_argument('-s', '--solver-seed', type=int, default=0,
+    help='CP-SAT random seed for every solve, unless a solver profile sets '
+         'random_seed.')
+  parser.add_argument('-v', '--verbose', action='store_true', default=False,
+    help='Show solver output.')
+
+  args = parser.parse_args()
+  params = Params()
+  params.time_limit = args.time_limit
+  for setting in args.param:
+    ParseParam(params, setting)
+
+  results = {
+    'started': datetime.datetime.now().isoformat(),
+    'ortools': ortools_version,
+    'time_limit': args.time_limit,
+    'cpu_count': os.cpu_count(),
+    'workers': args.workers,
+    'solver_seed': args.solver_seed,
+    'params': args.param,
+    'results': [],
+  }
+  for spec in TIERS:
+    if spec.name not in args.tiers:
+      continue
+    print('Running %s tier (%d riders, %d rides)...' %
+          (spec.name, spec.NumRiders(), spec.num_rides))
+    result = RunTier(spec, params, args.verbose, args.workers, args.solver_seed)
+    print(json.dumps(result, indent=2))
+    results['results'].append(result)
+
+  with open(args.output, 'w') as f:
+    json.dump(results, f, indent=2)
+  print('Wrote results to %s' % args.output)
+
+  if args.compare:
+    with open(args.compare) as f:
+      Compare(results, json.load(f))
@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from enum import Enum
+
+# Per-user, since cached results are loaded back and rosters name riders.
+CACHE_ROOT = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'sig_groups')
+DEFAULT_CACHE_DIR = os.path.join(CACHE_ROOT, 'solves')
+DEFAULT_FRAME_CACHE_DIR = os.path.join(CACHE_ROOT, 'frames')
+
+def MakePrivateDir(path):
+    '''
+    Creates path if needed, readable and writable only by the current user.
+    Raises PermissionError if it already exists and belongs to someone else.
+    '''
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.stat(path)
+    if st.st_uid != os.getuid():
+        raise PermissionError('%s is owned by another user' % path)
+    if st.st_mode & 0o077:
+        os.chmod(path, 0o700)
+
+def _Canonical(obj):
+    '''
+    Converts obj into plain JSON-able data with a stable ordering.
+    '''
+    if isinstance(obj, Enum):
+        return obj.name
+    if isinstance(obj, dict):
+        items = [[_Canonical(k), _Canonical(v)] for (k, v) in obj.items()]
+        return sorted(items, key=json.dumps)
+    if isinstance(obj, (set, frozenset)):
+        return sorted([_Canonical(x) for x in obj], key=json.dumps)
+    if isinstance(obj, (list, tuple)):
+        return [_Canonical(x) for x in obj]
+    if hasattr(obj, '__dict__'):
+        return [type(obj).__name__, _Canonical(vars(obj))]
+    return obj
+
+def HashInputs(*objs):
+    '''
+    Returns a stable hex digest of objs, which may be plain data or simple
+    objects like Rider, Match and Params.
+    '''
+    data = json.dumps(_Canonical(list(objs)))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+def _Encode(obj, arrays):
+    '''
+    Converts obj into JSON-able data, moving NumPy arrays into arrays and
+    tagging tuples and dicts so that _Decode can restore them.
+    '''
+    if isinstance(obj, np.ndarray):
+        name = 'a%d' % len(arrays)
+        arrays[name] = obj
+        return {'array': name}
+    if isinstance(obj, dict):
+        return {'dict': [[_Encode(k, arrays), _Encode(v, arrays)]
+                         for (k, v) in obj.items()]}
+    if isinstance(obj, tuple):
+        return {'tuple': [_Encode(x, arrays) for x in obj]}
+    if isinstance(obj, list):
+        return [_Encode(x, arrays) for x in obj]
+    return obj
+
+def _Decode(data, arrays):
+    if isinstance(data, list):
+        return [_Decode(x, arrays) for x in data]
+    if isinstance(data, dict):
+        if 'array' in data:
+            return arrays[data['array']]
+        if 'tuple' in data:
+            return tuple(_Decode(x, arrays) for x in data['tuple'])
+        return dict((_Decode(k, arrays), _Decode(v, arrays)) for (k, v) in data['dict'])
+    return data
+
+class SolveCache(object):
+    '''
+    A directory of solver results keyed by HashInputs digests.  Results are
+    stored as JSON, with any NumPy arrays in a .npz file next to it, so loading
+    them can't run code.  Once there are more than max_entries results the
+    least recently used are removed.
+    '''
+    EXTENSION = '.json'
+    ARRAYS_EXTENSION = '.npz'
+
+    def __init__(self, path=DEFAULT_CACHE_DIR, max_entries=32):
+        self.path = path
+        self.max_entries = max_entries
+
+    def _Path(self, key):
+        return os.path.join(self.path, key + self.EXTENSION)
+
+    def _ArraysPath(self, key):
+        return os.path.join(self.path, key + self.ARRAYS_EXTENSION)
+
+    def Get(self, key):
+        path = self._Path(key)
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            arrays = {}
+            if data['arrays']:
+                with np.load(self._ArraysPath(key), allow_pickle=False) as npz:
+                    arrays = dict((name, npz[name]) for name in data['arrays'])
+            value = _Decode(data['value'], arrays)
+            os.utime(path)
+            return value
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def Put(self, key, value):
+        MakePrivateDir(self.path)
+        arrays = {}
+        data = {'value': _Encode(value, arrays), 'arrays': sorted(arrays)}
+        # The arrays are written first, so an entry is only visible once its
+        # arrays are.
+        if arrays:
+            path = self._ArraysPath(key)
+            with open(path + '.tmp', 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(path + '.tmp', path)
+        path = self._Path(key)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(path + '.tmp', path)
+        self._Evict()
+
+    def _Evict(self):
+        entries = [os.path.join(self.path, x) for x in os.listdir(self.path)
+                   if x.endswith(self.EXTENSION)]
+        entries.sort(key=os.path.getmtime, reverse=True)
+        for path in entries[self.max_entries:]:
+            print('Evicting cached %s' % path)
+            os.remove(path)
+            arrays = path[:-len(self.EXTENSION)] + self.ARRAYS_EXTENSION
+            if os.path.exists(arrays):
+                os.remove(arrays)
+
+class FrameCache(SolveCache):
+    '''
+    A directory of rendered PNG frames keyed by a hash of what they show.
+    '''
+    EXTENSION = '.png'
+
+    def __init__(self, path=DEFAULT_FRAME_CACHE_DIR, max_entries=256):
+        super().__init__(path, max_entries)
+
+    def Get(self, key):
+        path = self._Path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = f.read()
+            os.utime(path)
+            return value
+        except OSError:
+            return None
+
+    def Put(self, key, value):
+        MakePrivateDir(self.path)
+        path = self._Path(key)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(value)
+        os.replace(path + '.tmp', path)
+        self._Evict()
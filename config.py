@@ -1,5 +1,7 @@
 import yaml
 
+from ortools.sat import sat_parameters_pb2
+
 class Config:
     def __init__(self, yaml):
         self.yaml = yaml
@@ -28,6 +30,24 @@ class Config:
     def AlgorithmParams(self):
         return self.yaml['algorithm']
 
+    def SolverProfile(self, solver_pass):
+        # The 'solver' profile applies to both passes, and is overridden by the
+        # pass specific 'group_size_solver' or 'pairings_solver' profile.
+        profile = dict(self.AlgorithmParams().get('solver', {}))
+        profile.update(self.AlgorithmParams().get('%s_solver' % solver_pass, {}))
+        # Catch typos here rather than when the pass's solver is created, which
+        # for pass 2 is after pass 1 has been solved.
+        fields = sat_parameters_pb2.SatParameters.DESCRIPTOR.fields_by_name
+        unknown = sorted(name for name in profile if name not in fields)
+        if unknown:
+            raise ValueError('Unknown CP-SAT parameters in the %s solver profile: %s' %
+                             (solver_pass, ', '.join(unknown)))
+        return profile
+
+    def Renderer(self):
+        # How pairing heatmaps are drawn: 'matplotlib' or the faster 'raster'.
+        return self.yaml.get('formatting', {}).get('renderer', 'matplotlib')
+
     def Constraints(self, ride):
         try:
             return self.yaml['rides'][ride]['constraints']
@@ -8,14 +8,18 @@ sys.path.insert(1, '/mnt/c/Users/Allison Fisher/SIG Groupings/')
 from sig_groups.ride import Ride, Rosters
 from sig_groups.config import LoadConfigFile
 from sig_groups.airtable import AirtableClient
+from sig_groups.cache import FrameCache
 from sig_groups.slack import SlackClient
+from sig_groups.snapshot import SnapshotStore
 from sig_groups.rider import RiderData
 from sig_groups.formatting import PrintRosters, GenerateGif
 
-def finalize(config, ride, publish=False):
+def finalize(config, ride, publish=False, offline=False):
     rides = [Ride(x) for x in config.Rides()]
 
-    airtable_client = AirtableClient(config.Airtable(), config.Rides())
+    airtable_client = AirtableClient(config.Airtable(), config.Rides(),
+                                     SnapshotStore(), offline)
+    airtable_client.Prefetch()
     rider_data = RiderData(airtable_client.LoadLeaders(), airtable_client.LoadParticipants())
 
     rosters = airtable_client.GetPriorRosters(rider_data)
@@ -26,7 +30,8 @@ def finalize(config, ride, publish=False):
     ride_rosters = Rosters(r for r in rosters if r.ride == ride)
     print('This is the finalized roster for ride %d...' % (ride+1))
     PrintRosters(ride_rosters.rosters, rider_data)
-    GenerateGif(config, rosters, rider_data)
+    GenerateGif(config, rosters, rider_data, [ride] if publish else [],
+                frame_cache=FrameCache())
 
     if (publish):
         print('Posting to slack...')
@@ -44,7 +49,13 @@ if __name__ == '__main__':
         default=False,
         help='Publish the finalized Roster.')
 
+    parser.add_argument('--offline', action='store_true', default=False,
+        help='Run from the local snapshot of the Airtable data synced by the '
+             'last run, without any network access.')
+
     args = parser.parse_args()
+    if args.offline and args.publish:
+        parser.error('--offline can\'t be combined with --publish')
     print('Loading config file %s....' % args.config)
     config = LoadConfigFile(args.config)
-    finalize(config, args.ride, args.publish)
+    finalize(config, args.ride, args.publish, args.offline)
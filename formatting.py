@@ -1,9 +1,19 @@
+import hashlib
 import imageio
-import matplotlib.pyplot as plt
+import io
+import json
+import os
 import pandas as pd
 import numpy as np
 
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageDraw, ImageFont
+
+# The ColorBrewer Blues anchors of matplotlib's Blues colormap.
+BLUES = np.array([[247, 251, 255], [222, 235, 247], [198, 219, 239],
+                  [158, 202, 225], [107, 174, 214], [66, 146, 198],
+                  [33, 113, 181], [8, 81, 156], [8, 48, 107]])
 
 def PrintAvailabilityTable(riders, num_rides):
     s = []
@@ -41,77 +51,231 @@ def PrintRosters(rosters, rider_data):
         for row in matrix:
             print(("{: <30} "*cols).format(*row))
 
-def GenerateGif(config, rosters, rider_data):
-    # map from ride -> pair
-    rides_together_through = defaultdict(lambda: defaultdict(lambda: 0))
+def RidesTogetherThrough(rosters, index, people, num_rides):
+    '''
+    Returns a (num_rides, n, n) array counting, for each ride, the rides up to
+    and including it on which each pair of people rode together.  people are
+    positions in the RiderIndex index.  The diagonal counts the rides each
+    person rode.
+    '''
+    # Map from index position -> position in people, or -1.
+    column = np.full(len(index), -1, dtype=np.int32)
+    column[people] = np.arange(len(people))
+    rosters = [r for r in rosters if r.ride < num_rides]
+    incidence = np.zeros((len(rosters), len(people)), dtype=np.int32)
+    for (k, r) in enumerate(rosters):
+      members = column[[index.position[p] for p in set(r.rider_ids) if p in index.position]]
+      incidence[k, members[members >= 0]] = 1
+    roster_ride = np.array([r.ride for r in rosters], dtype=np.int32)
 
-    for r in rosters:
-      seen = set()
-      for p1 in r.rider_ids:
-        for p2 in r.rider_ids:
-          canonical_pair = tuple(sorted((p1,p2)))
-          if canonical_pair in seen:
-            continue
-          seen.add(canonical_pair)
-          for i in range(r.ride, config.NumRides()):
-            rides_together_through[i][canonical_pair] += 1
+    together = np.zeros((num_rides, len(people), len(people)), dtype=np.int32)
+    for ride in range(0, num_rides):
+      a = incidence[roster_ride == ride]
+      together[ride] = a.T @ a
+    return np.cumsum(together, axis=0)
+
+def PairFrequencyPlot(modeled_pair_matrix, new_pair_matrix, labels, ride, num_rides, finalized):
+    '''
+    Renders the pair frequency heatmap of a ride and returns it as PNG bytes.
+    '''
+    # matplotlib is slow to import, so only load it when it's used.
+    import matplotlib.pyplot as plt
+    from matplotlib.figure import Figure
+
+    # A bare Figure rather than pyplot, so frames can be drawn in worker
+    # processes and are freed once rendered.
+    fig = Figure(figsize=(10,10))
+    ax1 = fig.subplots(1,1)
+    ax1.set_title('Pair Frequency: Modeled to Finish \\ Through Ride %d' % (ride + 1))
+    ax1.set_xticks(np.arange(0, len(labels), 1.0), labels=labels, minor=True, rotation=90, fontsize='small')
+    ax1.set_xticks(np.arange(0, len(labels), 1.0), labels=labels, minor=False, rotation=90, fontsize='small')
+    ax1.set_yticks(np.arange(0, len(labels), 1.0), labels=labels, minor=True, fontsize='small')
+    ax1.set_yticks(np.arange(0, len(labels), 1.0), labels=labels, minor=False, fontsize='small')
+
+    def highlight_cell(x,y, ax, **kwargs):
+        rect = plt.Rectangle((x-.5, y-.5), 1,1, fill=False, **kwargs)
+        ax.add_patch(rect)
+        return rect
+
+    ax1.matshow(modeled_pair_matrix, vmin=0, vmax=num_rides, cmap=plt.cm.Blues, aspect='equal')
+    for i in range(0, len(labels)):
+        for j in range(0, len(labels)):
+            c = modeled_pair_matrix[j,i]
+            ax1.text(i, j, str(int(c)), va='center', ha='center')
+            # Riding together on this ride
+            if new_pair_matrix[i][j]:
+                # First time riding together
+                if modeled_pair_matrix[i][j] == 1:
+                    highlight_cell(j, i, ax=ax1, color="green", linewidth=2)
+                else:
+                    highlight_cell(j, i, ax=ax1, color="red", linewidth=2)
+
+    buf = io.BytesIO()
+    facecolor = 'white' if finalized else 'yellow'
+    fig.savefig(buf, format='png', facecolor=facecolor, transparent=False, bbox_inches='tight')
+    return buf.getvalue()
+
+def _BlockImage(cells, block):
+    '''
+    Tiles an (n, m, ...) array of (k, k, ...) blocks into one (n*k, m*k, ...)
+    image.
+    '''
+    (n, m, k) = cells.shape[:3]
+    order = (0, 2, 1, 3) + tuple(range(4, cells.ndim))
+    return cells.transpose(order).reshape((n * k, m * k) + cells.shape[4:])
+
+def RasterPairFrequencyPlot(modeled_pair_matrix, new_pair_matrix, labels, ride, num_rides, finalized):
+    '''
+    Draws the same heatmap as PairFrequencyPlot directly with NumPy and Pillow
+    and returns it as PNG bytes.  Cells, counts and highlights are composed as
+    arrays, so only the labels are drawn one at a time.
+    '''
+    n = len(labels)
+    cell = max(16, min(36, 720 // max(n, 1)))
+    count_font = ImageFont.load_default(size=cell // 2)
+    label_font = ImageFont.load_default(size=12)
+    title_font = ImageFont.load_default(size=18)
+    title_height = 36
+    label_size = max([int(label_font.getlength(l)) for l in labels] + [0]) + 8
+    (top, left) = (title_height + label_size, label_size)
+    size = n * cell
+
+    # Cell colors, interpolated along the Blues colormap.
+    scale = np.clip(modeled_pair_matrix / num_rides, 0, 1) * (len(BLUES) - 1)
+    colors = np.stack([np.interp(scale, np.arange(len(BLUES)), BLUES[:, c])
+                       for c in range(3)], axis=-1)
+    grid = np.repeat(np.repeat(colors, cell, axis=0), cell, axis=1)
+
+    # Counts, from one anti-aliased glyph per distinct count.
+    counts = modeled_pair_matrix.astype(int)
+    glyphs = np.zeros((counts.max() + 1 if n else 1, cell, cell))
+    for c in np.unique(counts):
+        glyph = Image.new('L', (cell, cell), 0)
+        ImageDraw.Draw(glyph).text((cell / 2, cell / 2), str(c), fill=255,
+                                   font=count_font, anchor='mm')
+        glyphs[c] = np.asarray(glyph) / 255
+    alpha = _BlockImage(glyphs[counts], cell)
+    grid *= (1 - alpha)[:, :, None]
+
+    # Green outlines for pairs riding together for the first time on this
+    # ride, red for pairs riding together again.
+    border = np.zeros((cell, cell), dtype=bool)
+    border[:2, :] = border[-2:, :] = border[:, :2] = border[:, -2:] = True
+    together = new_pair_matrix != 0
+    for (mask, color) in [(together & (modeled_pair_matrix == 1), (0, 128, 0)),
+                          (together & (modeled_pair_matrix != 1), (255, 0, 0))]:
+        grid[_BlockImage(mask[:, :, None, None] & border, cell)] = color
+
+    background = (255, 255, 255) if finalized else (255, 255, 0)
+    pixels = np.empty((top + size + 8, left + size + 8, 3), dtype=np.uint8)
+    pixels[:] = background
+    pixels[top:top + size, left:left + size] = grid.round()
+    image = Image.fromarray(pixels)
+
+    draw = ImageDraw.Draw(image)
+    draw.text((left + size / 2, title_height / 2),
+              'Pair Frequency: Modeled to Finish \\ Through Ride %d' % (ride + 1),
+              fill=(0, 0, 0), font=title_font, anchor='mm')
+    # Row labels on the left, and column labels above reading upwards from the
+    # grid, drawn sideways and rotated.
+    columns = Image.new('L', (label_size, size), 0)
+    column_draw = ImageDraw.Draw(columns)
+    for (i, label) in enumerate(labels):
+        y = i * cell + cell / 2
+        draw.text((left - 4, top + y), label, fill=(0, 0, 0), font=label_font, anchor='rm')
+        column_draw.text((4, y), label, fill=255, font=label_font, anchor='lm')
+    image.paste((0, 0, 0), (left, title_height), columns.rotate(90, expand=True))
+
+    buf = io.BytesIO()
+    image.save(buf, format='png')
+    return buf.getvalue()
+
+RENDERERS = {
+    'matplotlib': PairFrequencyPlot,
+    'raster': RasterPairFrequencyPlot,
+}
+
+def _FrameKey(renderer, modeled_pair_matrix, new_pair_matrix, labels, ride, num_rides, finalized):
+    h = hashlib.sha256()
+    h.update(json.dumps([renderer, labels, ride, num_rides, finalized]).encode('utf-8'))
+    for matrix in (modeled_pair_matrix, new_pair_matrix):
+        h.update(str(matrix.shape).encode('utf-8'))
+        h.update(np.ascontiguousarray(matrix, dtype=np.int32).tobytes())
+    return h.hexdigest()
+
+def _Frames(config, rosters, rider_data):
+    '''
+    Returns the arguments to a renderer for the heatmap of each ride.
+    '''
+    num_rides = config.NumRides()
 
     # We want the chart to focus on riders attending more rides and filter out
     # those (particulary stale leader entries) that don't attend any.
-    people = sorted(rider_data.AllRiders(), key=lambda x: x.NumAvailableRides(), reverse=True)
-    people = [x for x in people if x.NumAvailableRides() > 0]
-
-    def PairFrequencyPlot(finalized, ride):
-        modeled_pair_matrix = np.zeros(shape=(len(people), len(people)))
-        new_pair_matrix = np.zeros(shape=(len(people), len(people)))
-        for i, p1 in enumerate(people):
-          for j, p2 in enumerate(people):
-            canonical_pair = tuple(sorted((p1.id, p2.id)))
-            if i <= j:
-                modeled_pair_matrix[i][j] = rides_together_through[ride][canonical_pair]
-                modeled_pair_matrix[j][i] = rides_together_through[config.NumRides() - 1][canonical_pair]
-                if i != j:
-                    new_pair_matrix[i][j] = (rides_together_through[ride][canonical_pair]
-                                             - rides_together_through[ride-1][canonical_pair])
-
-        labels = [p.name for p in people]
-
-        fig, (ax1) = plt.subplots(1,1,figsize=(10,10))
-        ax1.set_title('Pair Frequency: Modeled to Finish \ Through Ride %d' % (ride + 1))
-        ax1.set_xticks(np.arange(0, len(people), 1.0), labels=labels, minor=True, rotation=90, fontsize='small')
-        ax1.set_xticks(np.arange(0, len(people), 1.0), labels=labels, minor=False, rotation=90, fontsize='small')
-        ax1.set_yticks(np.arange(0, len(people), 1.0), labels=labels, minor=True, fontsize='small')
-        ax1.set_yticks(np.arange(0, len(people), 1.0), labels=labels, minor=False, fontsize='small')
-
-        def highlight_cell(x,y, ax=None, **kwargs):
-            rect = plt.Rectangle((x-.5, y-.5), 1,1, fill=False, **kwargs)
-            ax = ax or plt.gca()
-            ax.add_patch(rect)
-            return rect
-
-        ax1.matshow(modeled_pair_matrix, vmin=0, vmax=config.NumRides(), cmap=plt.cm.Blues, aspect='equal')
-        for i in range(0, len(people)):
-            for j in range(0, len(people)):
-                c = modeled_pair_matrix[j,i]
-                ax1.text(i, j, str(int(c)), va='center', ha='center')
-                # Riding together on this ride
-                if new_pair_matrix[i][j]:
-                    # First time riding together
-                    if modeled_pair_matrix[i][j] == 1:
-                        highlight_cell(j, i, ax=ax1, color="green", linewidth=2)
-                    else:
-                        highlight_cell(j, i, ax=ax1, color="red", linewidth=2)
-
-        if ride <= finalized:
-            fig.savefig('/tmp/pairings-%d.png' % ride, facecolor='white', transparent=False, bbox_inches='tight')
-        else:
-            fig.savefig('/tmp/pairings-%d.png' % ride, facecolor='yellow', transparent=False, bbox_inches='tight')
-
-    for i in range(0, config.NumRides()):
-        PairFrequencyPlot(config.Finalized(), i)
-
-    with imageio.get_writer('/tmp/pairs.gif', mode='I', fps=2, loop=0) as writer:
-        files = ['/tmp/pairings-%d.png' % i for i in range(0, config.NumRides())]
-        for filename in files:
-            image = imageio.imread(filename)
-            writer.append_data(image)
+    index = rider_data.Index()
+    order = np.argsort(-index.num_available_rides, kind='stable')
+    order = order[index.num_available_rides[order] > 0]
+    labels = [index.riders[i].name for i in order]
+
+    rides_together_through = RidesTogetherThrough(rosters, index, order, num_rides)
+
+    frames = []
+    for ride in range(0, num_rides):
+        # Above the diagonal through this ride, on and below it through the
+        # last ride.
+        through = rides_together_through[ride]
+        modeled_pair_matrix = np.triu(through, 1) + np.tril(rides_together_through[-1])
+        new_pair_matrix = np.triu(through, 1)
+        if ride > 0:
+            new_pair_matrix -= np.triu(rides_together_through[ride - 1], 1)
+        frames.append((modeled_pair_matrix, new_pair_matrix, labels, ride, num_rides,
+                       ride <= config.Finalized()))
+    return frames
+
+def FrameKeys(config, rosters, rider_data, renderer=None):
+    '''
+    Returns a key for the heatmap of each ride that changes whenever its image
+    does.  Every heatmap shows pairs through the last ride, so a change on one
+    ride can change the images of others.
+    '''
+    renderer = renderer or config.Renderer()
+    return [_FrameKey(renderer, *frame) for frame in _Frames(config, rosters, rider_data)]
+
+def GenerateGif(config, rosters, rider_data, png_rides=None, renderer=None,
+                frame_cache=None):
+    '''
+    Writes the pairing heatmap of every ride to /tmp/pairs.gif, and of each
+    ride in png_rides (by default all of them) to /tmp/pairings-<ride>.png for
+    posting to Slack.  renderer is a key of RENDERERS, by default the config's.
+    With a FrameCache only frames whose contents changed are rendered.
+    '''
+    renderer = renderer or config.Renderer()
+    render = RENDERERS[renderer]
+    if png_rides is None:
+        png_rides = range(0, config.NumRides())
+
+    frames = _Frames(config, rosters, rider_data)
+    keys = [_FrameKey(renderer, *frame) for frame in frames]
+    cached = [frame_cache.Get(key) if frame_cache else None for key in keys]
+    missing = [frame for (frame, png) in zip(frames, cached) if png is None]
+    if frame_cache:
+        print('Rendering %d of %d frames' % (len(missing), len(frames)))
+
+    # Frames are rendered in parallel and streamed into the GIF in ride order.
+    workers = min(os.cpu_count() or 1, len(missing))
+    executor = ProcessPoolExecutor(workers) if workers > 1 else None
+    try:
+        rendered = executor.map(render, *zip(*missing)) if executor else (
+            render(*frame) for frame in missing)
+        with imageio.get_writer('/tmp/pairs.gif', mode='I', fps=2, loop=0) as writer:
+            for (ride, png) in enumerate(cached):
+                if png is None:
+                    png = next(rendered)
+                    if frame_cache:
+                        frame_cache.Put(keys[ride], png)
+                if ride in png_rides:
+                    with open('/tmp/pairings-%d.png' % ride, 'wb') as f:
+                        f.write(png)
+                writer.append_data(imageio.imread(png))
+    finally:
+        if executor:
+            executor.shutdown()
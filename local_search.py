@@ -0,0 +1,266 @@
+import random
+import time
+
+import numpy as np
+
+# Weight on each violated hard constraint, so that any feasible roster scores
+# better than any infeasible one.
+VIOLATION_PENALTY = 100000
+
+class LocalSearch(object):
+  '''
+  Improves the pass 2 memberships of an AlgorithmTM within the topology chosen
+  by pass 1, by moving riders between groups and swapping pairs of riders.
+
+  The objective mirrors OptimizePairings (pairs that ride together, match
+  scores, together bonuses, scouted groups and inexperienced leader penalties)
+  up to a constant for the finalized rides and ignored riders, and the hard
+  constraints of AddGroupConstraints, AddRiderConstraints and the mentor
+  pairings are counted as violations.  Moves are scored incrementally from a
+  matrix counting how many rides each pair rides together.
+  '''
+  def __init__(self, alg, hints, seed=0):
+    self.alg = alg
+    self.params = alg.params
+    self.hints = hints
+    self.random = random.Random(seed)
+
+    rider_index = alg.index
+    self.ids = rider_index.ids
+    self.index = rider_index.position
+    n = len(rider_index)
+    num_rides = self.params.num_rides
+
+    self.is_leader = rider_index.is_leader
+    self.experienced = rider_index.experienced
+    self.inexperienced = rider_index.inexperienced
+    self.female = rider_index.female
+    self.male = rider_index.male
+    self.needs_woman_leader = rider_index.needs_woman_leader
+    self.scouted = np.array([rider_index.Scouted(alg.rides[r].airtable_id) & self.is_leader
+                             for r in range(0, num_rides)], dtype=bool).reshape(num_rides, n)
+
+    # Weight of a pair riding together at least once.  Pairs with an ignored
+    # rider are free in the model.
+    counted = ~rider_index.ignore
+    self.pair_weight = np.outer(counted, counted).astype(int)
+    np.fill_diagonal(self.pair_weight, 0)
+
+    # Weight of a pair riding together on each ride: match scores plus the
+    # together bonus for pairs that are both available.
+    self.ride_weight = alg.pair_weights.astype(int)
+    for weight in self.ride_weight:
+      np.fill_diagonal(weight, 0)
+
+    # Current group of each rider on each ride, or -1.
+    self.group = np.full((num_rides, n), -1, dtype=int)
+    fixed = np.zeros((num_rides, n), dtype=bool)
+    for roster in alg.prior_rosters:
+      if not roster.finalized or roster.ride >= num_rides:
+        continue
+      for p in roster.rider_ids:
+        if p in self.index:
+          self.group[roster.ride, self.index[p]] = roster.group
+          fixed[roster.ride, self.index[p]] = True
+
+    # With lookahead rides counted pairs that haven't ridden together on a
+    # finalized ride and can't ride together later count double.
+    if self.params.lookahead_rides > 0:
+      history = np.zeros((n, n), dtype=bool)
+      for r in range(0, num_rides):
+        g = np.where(fixed[r], self.group[r], -1)
+        history |= (g[:, None] == g[None, :]) & (g >= 0)[:, None]
+      later = np.array([rider_index.Available(r) for r in
+                        range(num_rides, num_rides + self.params.lookahead_rides)],
+                       dtype=bool).reshape(-1, n).astype(int)
+      never_later = (later.T @ later) == 0
+      self.pair_weight += never_later & ~history & np.outer(counted, counted)
+      np.fill_diagonal(self.pair_weight, 0)
+
+    for (r, g, i) in np.argwhere(hints['memberships'] > 0).tolist():
+      self.group[r, i] = g
+
+    # Number of rides each pair rides together.
+    self.count = np.zeros((n, n), dtype=int)
+    for r in range(0, num_rides):
+      same = self.group[r][:, None] == self.group[r][None, :]
+      self.count += same & (self.group[r] >= 0)[:, None]
+    np.fill_diagonal(self.count, 0)
+
+    # Rides and riders the search is allowed to change.
+    self.open_rides = [r for r in range(self.params.start_ride, num_rides)
+                       if r > self.params.finalized_ride and r in hints['num_groups']]
+    self.movable = {}
+    for r in self.open_rides:
+      self.movable[r] = list(np.flatnonzero((self.group[r] >= 0) & ~fixed[r]))
+
+    self.mentors = dict((r, []) for r in self.open_rides)
+    for (r, i, j) in self._MentorPairs():
+      if r in self.mentors:
+        self.mentors[r].append((i, j))
+
+  def _MentorPairs(self):
+    '''
+    Yields (r, i, j) for mentor pairs constrained to ride together on ride r,
+    the first ride from the second onwards where both are available.
+    '''
+    for (j, (i, r)) in self.alg.index.mentees.items():
+      if self.params.start_ride <= r < self.params.num_rides:
+        yield (r, i, j)
+
+  def _GroupValue(self, r, g):
+    '''
+    Returns the group level score of (r, g) less its constraint violations.
+    '''
+    (score, violations) = self._GroupScore(r, g)
+    return score - VIOLATION_PENALTY * violations
+
+  def _GroupScore(self, r, g):
+    '''
+    Returns (group level score, number of violated constraints) of (r, g).
+    '''
+    m = self.group[r] == g
+    size = m.sum()
+    if g >= self.hints['num_groups'][r]:
+      return (0, int(size > 0))
+    leaders = (m & self.is_leader).sum()
+    participants = size - leaders
+    inexperienced = (m & self.inexperienced).sum()
+    target_participants = self.hints['target_participants'][r]
+    target_leaders = self.hints['target_leaders'][r]
+    violations = (int(size == 0) +
+                  int(leaders < 2) +
+                  int((m & self.experienced).sum() < 1) +
+                  int((m & self.female).sum() == 1) +
+                  int((m & self.male).sum() == 1) +
+                  int(not target_participants <= participants <= target_participants + 1) +
+                  int(not target_leaders <= leaders <= target_leaders + 1) +
+                  int((m & self.needs_woman_leader).any() and
+                      not (m & self.is_leader & self.female).any()))
+    # OptimizePairings builds this penalty with AddAbsEquality, which in
+    # OR-Tools 9.12 computes max(e, -e - 4) for e = leaders - inexperienced - 2
+    # rather than |e|.
+    e = leaders - inexperienced - 2
+    return (-200 * max(e, -e - 4), violations)
+
+  def _RideValue(self, r):
+    '''
+    Returns the ride level score of ride r less its constraint violations.
+    '''
+    (score, violations) = self._RideScore(r)
+    return score - VIOLATION_PENALTY * violations
+
+  def _RideScore(self, r):
+    '''
+    Returns (ride level score, number of violated constraints) of ride r.
+    '''
+    num_groups = self.hints['num_groups'][r]
+    scout_groups = len(set(self.group[r][self.scouted[r] & (self.group[r] >= 0)]))
+    target = min(self.alg.num_available_scouts[r], num_groups)
+    violations = int(scout_groups != target)
+    for (i, j) in self.mentors[r]:
+      violations += int(self.group[r, i] != self.group[r, j])
+    return (100 * scout_groups, violations)
+
+  def _Move(self, r, i, b):
+    '''
+    Moves rider i to group b on ride r and returns the change in pair score.
+    '''
+    a = self.group[r, i]
+    ma = self.group[r] == a
+    ma[i] = False
+    mb = self.group[r] == b
+    count = self.count[i]
+    delta = (self.pair_weight[i, mb & (count == 0)].sum() -
+             self.pair_weight[i, ma & (count == 1)].sum() +
+             self.ride_weight[r][i, mb].sum() -
+             self.ride_weight[r][i, ma].sum())
+    self.count[i, ma] -= 1
+    self.count[ma, i] -= 1
+    self.count[i, mb] += 1
+    self.count[mb, i] += 1
+    self.group[r, i] = b
+    return delta
+
+  def Score(self):
+    '''
+    Returns the full objective of the current memberships.
+    '''
+    score = (self.pair_weight * (self.count > 0)).sum() // 2
+    for r in range(0, self.params.num_rides):
+      same = self.group[r][:, None] == self.group[r][None, :]
+      same &= (self.group[r] >= 0)[:, None]
+      score += (self.ride_weight[r] * same).sum() // 2
+    for r in self.open_rides:
+      score += self._RideValue(r)
+      for g in range(0, self.params.max_groups):
+        score += self._GroupValue(r, g)
+    return score
+
+  def Run(self, time_limit):
+    '''
+    Hill climbs (accepting sideways moves) for time_limit seconds.
+    '''
+    start = time.time()
+    initial = self.Score()
+    attempted = accepted = 0
+    rides = [r for r in self.open_rides if len(self.movable[r]) > 1]
+    while rides and time.time() - start < time_limit:
+      attempted += 1
+      r = self.random.choice(rides)
+      i = self.random.choice(self.movable[r])
+      a = self.group[r, i]
+      b = self.random.randrange(self.hints['num_groups'][r])
+      if a == b:
+        continue
+      j = None
+      if self.random.random() < 0.5:
+        in_b = [x for x in self.movable[r] if self.group[r, x] == b]
+        if in_b:
+          j = self.random.choice(in_b)
+
+      before = self._RideValue(r) + self._GroupValue(r, a) + self._GroupValue(r, b)
+      delta = self._Move(r, i, b)
+      if j is not None:
+        delta += self._Move(r, j, a)
+      after = self._RideValue(r) + self._GroupValue(r, a) + self._GroupValue(r, b)
+      delta += after - before
+
+      if delta >= 0:
+        accepted += 1
+        continue
+      if j is not None:
+        self._Move(r, j, b)
+      self._Move(r, i, a)
+
+    print('Local search: %d of %d moves accepted in %.2f s, score %d -> %d' %
+          (accepted, attempted, time.time() - start, initial, self.Score()))
+
+  def Violations(self):
+    '''
+    Returns the number of hard constraints the current memberships violate.
+    '''
+    violations = 0
+    for r in self.open_rides:
+      violations += self._RideScore(r)[1]
+      for g in range(0, self.params.max_groups):
+        violations += self._GroupScore(r, g)[1]
+    return violations
+
+  def Memberships(self):
+    '''
+    Returns the (r, g, p) slots that are 1 in the current memberships.
+    '''
+    memberships = []
+    for (r, i) in zip(*np.nonzero(self.group >= 0)):
+      memberships.append((int(r), int(self.group[r, i]), self.ids[i]))
+    return memberships
+
+  def Hints(self):
+    '''
+    Returns the pass 1 hints with the memberships replaced by the current ones.
+    '''
+    hinted = self.hints['memberships'] >= 0
+    groups = np.arange(hinted.shape[1])[None, :, None]
+    current = self.group[:, None, :] == groups
+    return dict(self.hints, memberships=np.where(hinted, current, -1).astype(np.int8))
@@ -7,17 +7,23 @@ sys.path.insert(1, '/usr/local/google/home/amfisher/dsig24/')
 sys.path.insert(1, '/mnt/c/Users/Allison Fisher/SIG Groupings/')
 
 from sig_groups.airtable import AirtableClient
+from sig_groups.cache import FrameCache, SolveCache
 from sig_groups.config import LoadConfigFile
-from sig_groups.formatting import PrintAvailabilityTable, PrintRosters, GenerateGif
+from sig_groups.formatting import PrintAvailabilityTable, PrintRosters, FrameKeys, GenerateGif
 from sig_groups.optimizer import AlgorithmTM, Params
-from sig_groups.ride import Ride, Rosters
+from sig_groups.profiler import Profiler
+from sig_groups.ride import Ride, RosterDiff, Rosters
 from sig_groups.rider import RiderData
 from sig_groups.slack import SlackClient
+from sig_groups.snapshot import SnapshotStore
 
-def run_algorithm(config, publish=False):
+def run_algorithm(config, publish=False, use_cache=True, engine=None,
+                  profile=None, offline=False):
   rides = [Ride(x) for x in config.Rides()]
 
-  airtable_client = AirtableClient(config.Airtable(), config.Rides())
+  airtable_client = AirtableClient(config.Airtable(), config.Rides(),
+                                   SnapshotStore(), offline)
+  airtable_client.Prefetch()
 
   rider_data = RiderData(airtable_client.LoadLeaders(), airtable_client.LoadParticipants())
   for m in config.Matches():
@@ -32,35 +38,58 @@ def run_algorithm(config, publish=False):
   params.max_group_size = config.AlgorithmParams()['max_group_size']
   params.time_limit = config.AlgorithmParams()['time_limit']
   params.num_rides = config.AlgorithmParams()['num_rides']
+  params.symmetry_breaking = config.AlgorithmParams().get('symmetry_breaking', False)
+  params.warm_start = config.AlgorithmParams().get('warm_start', False)
+  params.warm_start_topology = config.AlgorithmParams().get('warm_start_topology', False)
+  params.horizon = config.AlgorithmParams().get('horizon', 0)
+  params.horizon_step = config.AlgorithmParams().get('horizon_step', 1)
+  params.engine = engine or config.AlgorithmParams().get('engine', 'cp-sat')
+  params.local_search_time = config.AlgorithmParams().get('local_search_time', 1.0)
+  params.local_search_presolve = config.AlgorithmParams().get('local_search_presolve', False)
+  params.pairing_encoding = config.AlgorithmParams().get('pairing_encoding', 'membership')
+  params.group_size_solver = config.SolverProfile('group_size')
+  params.pairings_solver = config.SolverProfile('pairings')
 
   for ride in rides:
     for constraint in config.Constraints(ride.num):
       ride.AddTogetherConstraint(constraint['riders'])
 
-  alg = AlgorithmTM(rider_data, rides, prior_rosters, params)
+  cache = SolveCache() if use_cache else None
+  profiler = Profiler()
+  alg = AlgorithmTM(rider_data, rides, prior_rosters, params, cache, profiler)
   rosters = alg.Solve()
+  if profile:
+    profiler.Print()
+    profiler.Write(profile)
   PrintRosters(rosters, rider_data)
 
   print('Generating pairing images...')
-  GenerateGif(config, rosters, rider_data)
+  # Slack posts need the PNG of each published ride.
+  png_rides = range(params.start_ride, params.num_rides) if publish else []
+  GenerateGif(config, rosters, rider_data, png_rides, frame_cache=FrameCache())
 
   if publish:
     print('Publishing output...')
+    diff = RosterDiff(rosters, prior_rosters, range(params.start_ride, params.num_rides))
+    diff.Print()
+    # A ride's Slack post shows its heatmap, which can change even when its
+    # groups didn't.
+    prior_frames = FrameKeys(config, prior_rosters, rider_data)
+    frames = FrameKeys(config, rosters, rider_data)
+    slack_rides = sorted(set(diff.ChangedRides()) |
+                         set(r for r in range(params.start_ride, params.num_rides)
+                             if frames[r] != prior_frames[r]))
+    if not slack_rides:
+      print('No rosters changed, nothing to publish.')
+      return
+
     slack_client = SlackClient(config.Slack(), rides)
     slack_client.PostRosterStatus()
 
-    for ride in range(params.start_ride, params.num_rides):
-        ride_rosters = Rosters(r for r in rosters if r.ride == ride)
-        ride_prior_rosters = Rosters(r for r in prior_rosters if r.ride == ride)
-
-        print('Ride %d - modeled %d rosters, previously %d rosters' %
-              (ride, ride_rosters.NumRosters(), ride_prior_rosters.NumRosters()))
-        for roster in ride_prior_rosters.rosters[ride_rosters.NumRosters():]:
-            airtable_client.DeleteRoster(roster, rides)
-
-        for roster in ride_rosters.rosters:
-            airtable_client.CreateRoster(roster, rides)
-        slack_client.PostRoster(ride_rosters)
+    if diff.ChangedRides():
+      airtable_client.WriteRosters(diff.Writes(), diff.removed, rides)
+    for ride in slack_rides:
+        slack_client.PostRoster(Rosters(r for r in rosters if r.ride == ride))
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser(prog='main.py',
@@ -72,8 +101,27 @@ if __name__ == '__main__':
          'false the results won\'t be published.')
   parser.add_argument('-c', '--config', help='Config file path',
     default='configs/2025.yaml')
+  parser.add_argument('--no-cache', dest='cache', action='store_false',
+    default=True,
+    help='Always run the solver instead of reusing results cached for '
+         'unchanged inputs.')
+
+  parser.add_argument('-e', '--engine', choices=['cp-sat', 'local'],
+    help='Engine for assigning riders to groups: CP-SAT, or a fast local '
+         'search.  Defaults to the config, or cp-sat.')
+
+  parser.add_argument('--profile', nargs='?', const='/tmp/sig_groups_profile.json',
+    help='Write a JSON report of the time, memory and model size of each '
+         'optimizer phase (by default to /tmp/sig_groups_profile.json).')
+
+  parser.add_argument('--offline', action='store_true', default=False,
+    help='Run from the local snapshot of the Airtable data synced by the last '
+         'run, without any network access.')
 
   args = parser.parse_args()
+  if args.offline and args.publish:
+    parser.error('--offline can\'t be combined with --publish')
   print('Loading config file %s....' % args.config)
   config = LoadConfigFile(args.config)
-  run_algorithm(config, args.publish)
+  run_algorithm(config, args.publish, args.cache, args.engine, args.profile,
+                args.offline)
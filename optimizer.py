@@ -1,13 +1,25 @@
+import copy
 import math
 import random
+import time
+
+import numpy as np
 
 from collections import defaultdict, OrderedDict
 from ortools.sat.python import cp_model
 
+from sig_groups.cache import HashInputs
+from sig_groups.local_search import LocalSearch
+from sig_groups.profiler import Profiler
 from sig_groups.ride import Roster
-from sig_groups.rider import Leader, Participant, Match
+from sig_groups.rider import Participant, Match
 from sig_groups.formatting import PrintRosters
 
+# Part of every cache key.  Bump it whenever a change to the model or to what
+# the cache stores could change the results, so older cached rosters aren't
+# reused.
+MODEL_VERSION = 8
+
 class Params(object):
     def __init__(self):
         # Hard limits on group sizes.
@@ -28,13 +40,77 @@ class Params(object):
         # The last finalized ride (i.e. the last one that happened already).
         self.finalized_ride = 0
 
+        # Only create membership variables for (ride, group, rider) slots that
+        # can actually be 1.  Finalized rosters are folded in as constants.
+        self.sparse_memberships = True
+
+        # Break the symmetry between interchangeable groups on open rides by
+        # ordering groups by their first leader.
+        self.symmetry_breaking = False
+
+        # Hint pass 2 memberships with the draft (non-finalized) rosters from
+        # the previous run, and optionally hint pass 1 with their topology.
+        self.warm_start = False
+        self.warm_start_topology = False
+
+        # CP-SAT parameters for each pass as a map from SatParameters field
+        # name to value, e.g. num_workers, subsolvers, random_seed, use_lns,
+        # relative_gap_limit.
+        self.group_size_solver = {}
+        self.pairings_solver = {}
+
+        # When non-zero, solve in a rolling horizon: optimize a window of this
+        # many rides, commit the first horizon_step of them, and slide forward.
+        self.horizon = 0
+        self.horizon_step = 1
+
+        # Rides after num_rides that are only summarized, by favoring pairs
+        # that can't ride together on any of them (set by the rolling horizon).
+        self.lookahead_rides = 0
+
+        # The pass 2 engine, either 'cp-sat' or 'local' (LocalSearch only).
+        self.engine = 'cp-sat'
+
+        # Seconds to run LocalSearch for, and whether to run it before CP-SAT
+        # in pass 2 to hint the memberships.
+        self.local_search_time = 1.0
+        self.local_search_presolve = False
+
+        # How pass 2 encodes pairs riding together: 'membership' reifies the
+        # pair in each group of a ride, 'assignment' compares the riders'
+        # group numbers so each pair needs one variable per ride, not per group.
+        self.pairing_encoding = 'membership'
+
 def VarName(prefix, params):
   return ('%s_' % prefix) + '_'.join(map(str, params))
 
+def Sum(terms):
+  '''
+  Returns the sum of terms as a single LinearExpr, or as an int when every term
+  is a constant (e.g. a folded membership).
+  '''
+  if all(isinstance(x, int) for x in terms):
+    return sum(terms)
+  return cp_model.LinearExpr.Sum(terms)
+
+def SolutionValues(response):
+  '''
+  Returns the value of every variable in a CpSolverResponse as an array indexed
+  by variable index.
+  '''
+  return np.array(response.solution, dtype=np.int64)
+
 class Vars(object):
   def __init__(self):
-    # Map from (r, g, p) -> bool.
-    self.memberships = {}
+    # Memberships as dense (r, g, i) arrays over rider positions: the bool
+    # variable or None, its index in the model or -1, and whether the slot is
+    # fixed to 1.  With sparse memberships only the slots that can be 1 have a
+    # variable, and slots of finalized rosters are fixed.
+    self.ids = ()
+    self.position = {}
+    self.membership_vars = np.empty((0, 0, 0), dtype=object)
+    self.membership_index = np.empty((0, 0, 0), dtype=np.int32)
+    self.membership_fixed = np.empty((0, 0, 0), dtype=bool)
 
     # Map from (r, g) -> bool.
     self.group_active = {}
@@ -47,33 +123,119 @@ class Vars(object):
 
     ### Derived variables.
 
-    # Map from (r, g) -> [bool]
-    self.groups = defaultdict(lambda: [])
-    self.group_participants = defaultdict(lambda: [])
-    self.group_leaders = defaultdict(lambda: [])
-    self.group_leaders_experienced = defaultdict(lambda: [])
-    self.group_leaders_inexperienced = defaultdict(lambda: [])
-    self.group_leaders_scouted = defaultdict(lambda: [])
-    self.group_leaders_female = defaultdict(lambda: [])
+    # Map from (r, g) -> GroupSum of the group's riders, participants, leaders
+    # and so on.  Groups with only constant memberships (i.e. finalized) have
+    # int sums.
+    self.group_size = {}
+    self.num_participants = {}
+    self.num_leaders = {}
+    self.num_leaders_experienced = {}
+    self.num_leaders_inexperienced = {}
+    self.num_leaders_scouted = {}
+    self.num_leaders_female = {}
 
-    # Map from (r, g) -> gender -> [bool]
-    self.groups_genders = defaultdict(lambda: defaultdict(lambda: []))
+    # Map from (r, g) -> gender -> GroupSum of riders of that gender.
+    self.num_genders = {}
 
     # Map from (p1, p2) -> bool indicating that these two people rode together.
     self.paired = {}
+
+    # Map from (r, p) -> int group number of p on ride r (assignment pairing
+    # encoding only).
+    self.group_of = {}
+
+  def Membership(self, r, g, p):
+    '''
+    Returns the membership variable for (r, g, p), or the constant 0/1 when the
+    slot was folded out of the model.
+    '''
+    return self.MembershipAt(r, g, self.position[p])
+
+  def MembershipAt(self, r, g, i):
+    '''
+    Returns Membership for the rider at position i.
+    '''
+    me = self.membership_vars[r, g, i]
+    if me is None:
+      return int(self.membership_fixed[r, g, i])
+    return me
+
+  def GroupSum(self, r, g, mask):
+    '''
+    Returns the Sum of the memberships of group g on ride r of the riders in
+    mask, a boolean array over rider positions.
+    '''
+    terms = self.membership_vars[r, g, mask & (self.membership_index[r, g] >= 0)].tolist()
+    terms.extend([1] * int(np.count_nonzero(mask & self.membership_fixed[r, g])))
+    return Sum(terms)
+
+  def SelectedMemberships(self, values):
+    '''
+    Returns the (r, g, p) slots that are 1, given the SolutionValues of a
+    solution.
+    '''
+    selected = self.membership_fixed.copy()
+    has_var = self.membership_index >= 0
+    selected[has_var] = values[self.membership_index[has_var]] != 0
+    return [(r, g, self.ids[i]) for (r, g, i) in np.argwhere(selected).tolist()]
+
+  def MembershipHints(self, values):
+    '''
+    Returns the value of each membership variable in the SolutionValues of a
+    solution, as an int8 (r, g, i) array that is -1 for slots without one.
+    This is the format of the memberships in hints.
+    '''
+    hints = np.full(self.membership_index.shape, -1, dtype=np.int8)
+    has_var = self.membership_index >= 0
+    hints[has_var] = values[self.membership_index[has_var]] != 0
+    return hints
+
+  def FixMemberships(self, model, memberships):
+    '''
+    Constrains the membership variables to be 1 exactly for the (r, g, p) slots
+    in memberships.
+    '''
+    selected = np.zeros(self.membership_index.shape, dtype=bool)
+    for (r, g, p) in memberships:
+      if p in self.position:
+        selected[r, g, self.position[p]] = True
+    has_var = self.membership_index >= 0
+    for (me, v) in zip(self.membership_vars[has_var].tolist(), selected[has_var].tolist()):
+      model.Add(me == int(v))
+
   def RecordHints(self, solver):
-    hints = {}
+    values = SolutionValues(solver.ResponseProto())
+    hints = {'memberships': self.MembershipHints(values)}
     def log_map(name, var):
-      hints[name] = {}
-      for (k,v) in var.items():
-          hints[name][k] = solver.Value(v)
-    log_map("memberships", self.memberships)
+      indices = np.array([v.Index() for v in var.values()], dtype=np.int64)
+      hints[name] = dict(zip(var, values[indices].tolist()))
     log_map("group_active", self.group_active)
     log_map("num_groups", self.num_groups)
     log_map("target_participants", self.target_participants)
     log_map("target_leaders", self.target_leaders)
     return hints
 
+  def AddHints(self, model, hints):
+    '''
+    Adds every value in hints (as returned by RecordHints) as a solver hint.
+    '''
+    self.AddMembershipHints(model, hints['memberships'])
+    for name in hints:
+      if name == 'memberships':
+        continue
+      var = getattr(self, name)
+      for (k,v) in hints[name].items():
+        if k in var:
+          model.AddHint(var[k], v)
+
+  def AddMembershipHints(self, model, hints):
+    '''
+    Hints the membership variables with the values in a MembershipHints array.
+    '''
+    hinted = (hints >= 0) & (self.membership_index >= 0)
+    for (me, v) in zip(self.membership_vars[hinted].tolist(), hints[hinted].tolist()):
+      model.AddHint(me, v)
+
   def RestoreHints(self, model, hints):
     def restore(name, var, constraint=None):
       for k in hints[name]:
@@ -82,7 +244,7 @@ class Vars(object):
         else:
           model.AddHint(var[k], hints[name][k])
 
-    restore("memberships", self.memberships)
+    self.AddMembershipHints(model, hints['memberships'])
     restore("group_active", self.group_active, constraint=True)
     restore("num_groups", self.num_groups, constraint=True)
     restore("target_participants", self.target_participants, constraint=True)
@@ -96,10 +258,7 @@ class Printer(cp_model.CpSolverSolutionCallback):
     self.riders = riders
 
   def on_solution_callback(self):
-    memberships = []
-    for (k,v) in self.vars.memberships.items():
-      if (self.Value(v)):
-        memberships.append(k)
+    memberships = self.vars.SelectedMemberships(SolutionValues(self.Response()))
 
     groups = defaultdict(lambda: defaultdict(lambda: []))
     for (r, g, p) in memberships:
@@ -112,23 +271,43 @@ class Printer(cp_model.CpSolverSolutionCallback):
 
 
 class AlgorithmTM(object):
-  def __init__(self, riders, rides, prior_rosters, params):
+  def __init__(self, riders, rides, prior_rosters, params, cache=None,
+               profiler=None, printer=None):
     self.riders = riders
     self.rides = {}
     for r in rides:
         self.rides[r.num] = r
     self.prior_rosters = prior_rosters
     self.params = params
+    self.cache = cache
+    self.profiler = profiler or Profiler()
+    # Called as printer(vars, riders) for the solution callback of each solve.
+    self.printer = printer or Printer
+    self.index = riders.Index()
+    self.num_leaders = len(riders.AllLeaders())
+    self.num_participants = len(riders.AllParticipants())
+
+    # can_ride[r, i] is whether the model is free to place rider i on ride r.
+    self.can_ride = np.zeros((params.num_rides, len(self.index)), dtype=bool)
+    for r in range(params.finalized_ride + 1, params.num_rides):
+      self.can_ride[r] = r < params.start_ride or self.index.Available(r)
+
+    # together[r, i, j] is whether riders i and j should ride together on ride
+    # r and are both available, and pair_weights[r, i, j] is the score for
+    # them riding together on ride r: 1000 if so plus their match score.
+    n = len(self.index)
+    self.together = np.zeros((params.num_rides, n, n), dtype=bool)
+    for r in range(0, params.num_rides):
+      available = self.index.Available(r)
+      self.together[r] = (self.rides[r].TogetherMatrix(self.index) &
+                          np.outer(available, available))
+    self.pair_weights = riders.MatchScores() + 1000 * self.together.astype(np.int32)
 
     # map from r -> int
     self.num_available_scouts = defaultdict(lambda: 0)
-    num_available_leaders = defaultdict(lambda: 0)
     for r in range(0, params.num_rides):
-      for p in self.riders.AllLeaders():
-        if p.IsLeader() and p.Scouted(self.rides[r].airtable_id):
-          self.num_available_scouts[r] += 1
-        if p.IsAvailable(r):
-          num_available_leaders[r] += 1
+      self.num_available_scouts[r] = int(np.count_nonzero(
+          self.index.Scouted(self.rides[r].airtable_id) & self.index.is_leader))
     for r in range(0, params.num_rides):
       print('Ride %d has %d available scouts' % (r, self.num_available_scouts[r]))
 
@@ -152,62 +331,156 @@ class AlgorithmTM(object):
         rosters.append(Roster(self.riders, None, r, g, data[(r,g)]))
     return rosters
 
+  def FinalizedPairs(self):
+    '''
+    Returns a map from (p1, p2) -> set of finalized rides they rode together on.
+    '''
+    pairs = defaultdict(set)
+    for roster in self.prior_rosters:
+      if not roster.finalized or roster.ride > self.params.finalized_ride:
+        continue
+      for p1 in roster.rider_ids:
+        for p2 in roster.rider_ids:
+          if p1 != p2:
+            pairs[(p1, p2)].add(roster.ride)
+    return pairs
+
+  def DraftHints(self, has_var):
+    '''
+    Returns hints, in the format of Vars.RecordHints, built from the draft
+    (non-finalized) prior rosters.  Only open rides with drafts are included.
+    has_var[r, g, i] is whether the model has a membership variable for the
+    slot.
+    '''
+    drafts = defaultdict(lambda: defaultdict(lambda: []))
+    position = self.index.position
+    selected = np.zeros(has_var.shape, dtype=bool)
+    for roster in self.prior_rosters:
+      if (roster.finalized or roster.ride < self.params.start_ride or
+          roster.ride <= self.params.finalized_ride or
+          roster.ride >= self.params.num_rides or
+          roster.group >= self.params.max_groups):
+        continue
+      for p in roster.rider_ids:
+        if p in position and self.can_ride[roster.ride, position[p]]:
+          drafts[roster.ride][roster.group].append(p)
+          selected[roster.ride, roster.group, position[p]] = True
+
+    hints = {'memberships': np.full(selected.shape, -1, dtype=np.int8),
+             'group_active': {}, 'num_groups': {},
+             'target_participants': {}, 'target_leaders': {}}
+    for r in drafts:
+      hints['memberships'][r] = np.where(has_var[r], selected[r], -1)
+    for r in drafts:
+      groups = [g for g in drafts[r] if len(drafts[r][g]) > 0]
+      if len(groups) == 0:
+        continue
+      leaders = [len([p for p in drafts[r][g] if self.riders.Rider(p).IsLeader()])
+                 for g in groups]
+      participants = [len(drafts[r][g]) - l for (g, l) in zip(groups, leaders)]
+      for g in range(0, self.params.max_groups):
+        hints['group_active'][(r, g)] = int(g in groups)
+      hints['num_groups'][r] = len(groups)
+      hints['target_participants'][r] = min(participants)
+      hints['target_leaders'][r] = min(leaders)
+    return hints
+
+  def ApplyDraftHints(self, hints):
+    '''
+    Returns the pass 1 hints with the memberships of the riders in the draft
+    rosters replaced by their draft groups, on rides where pass 1 kept the
+    draft's number of groups.  Riders the drafts leave out keep their pass 1
+    groups, so that every available rider is still in one group.
+    '''
+    drafts = self.DraftHints(hints['memberships'] >= 0)
+    hints = dict(hints, memberships=hints['memberships'].copy())
+    for r in sorted(drafts['num_groups']):
+      if hints['num_groups'].get(r) != drafts['num_groups'][r]:
+        continue
+      print('Warm starting ride %d from draft rosters' % r)
+      draft = drafts['memberships'][r]
+      placed = (draft > 0).any(axis=0)
+      hints['memberships'][r][:, placed] = draft[:, placed]
+    return hints
+
   def InitializeModel(self, model, vars):
-   # Setup a boolean matrix for each rider in every group on every ride.
-    for p in self.riders.AllRiders():
+    # Historical rosters are constrained to what they were.
+    prior_ride_true = set()
+    for roster in self.prior_rosters:
+      if roster.finalized:
+        for rider in [self.riders.Rider(r) for r in roster.rider_ids]:
+          prior_ride_true.add((roster.ride, roster.group, rider.id))
+
+    # Setup a boolean matrix for each rider in every group on every ride.  In
+    # sparse mode slots that can't be 1 (finalized, or the rider is unavailable)
+    # have no variable and finalized memberships are constants.
+    sparse = self.params.sparse_memberships
+    index = self.index
+    shape = (self.params.num_rides, self.params.max_groups, len(index))
+    vars.ids = index.ids
+    vars.position = index.position
+    vars.membership_vars = np.full(shape, None, dtype=object)
+    vars.membership_index = np.full(shape, -1, dtype=np.int32)
+    vars.membership_fixed = np.zeros(shape, dtype=bool)
+    for (i, p) in enumerate(index.ids):
+      can_ride = self.can_ride[:, i].tolist()
       for r in range(0, self.params.num_rides):
         for g in range(0, self.params.max_groups):
-          vars.memberships[(r, g, p.id)] = model.NewBoolVar(VarName('membership', [r, g, p.id]))
-
-    # Each group in the array is an individual (r, g) list of participant bools.
-    # Add references into the boolean matrix for different breakdowns by group,
-    # gender, leader, etc.
+          if sparse:
+            if (r, g, p) in prior_ride_true:
+              vars.membership_fixed[r, g, i] = True
+              continue
+            if not can_ride[r]:
+              continue
+          me = model.NewBoolVar(VarName('membership', [r, g, p]))
+          vars.membership_vars[r, g, i] = me
+          vars.membership_index[r, g, i] = me.Index()
+
+    # Sum each group by gender, leader, etc. from masks over rider positions.
+    everyone = np.ones(len(index), dtype=bool)
+    participants = ~index.is_leader
+    female_leaders = index.is_leader & index.female
     for r in range(0, self.params.num_rides):
       num_scout_groups = []
+      scouted = index.Scouted(self.rides[r].airtable_id) & index.is_leader
       for g in range(0, self.params.max_groups):
         vars.group_active[(r,g)] = model.NewBoolVar(VarName('group_active', [r, g]))
-        num_scouts_group = []
-        for p in self.riders.AllRiders():
-          me = vars.memberships[(r, g, p.id)]
-
-          vars.groups[(r,g)].append(me)
-          vars.groups_genders[(r,g)][p.gender].append(me)
-          if p.IsLeader():
-            vars.group_leaders[(r,g)].append(me)
-            if p.type == Leader.Type.EXPERIENCED:
-              vars.group_leaders_experienced[(r,g)].append(me)
-            if p.type == Leader.Type.INEXPERIENCED:
-              vars.group_leaders_inexperienced[(r,g)].append(me)
-            if p.Scouted(self.rides[r].airtable_id):
-              vars.group_leaders_scouted[(r,g)].append(me)
-              num_scouts_group.append(me)
-            if p.gender == 'F':
-              vars.group_leaders_female[(r,g)].append(me)
-          else:
-            vars.group_participants[(r,g)].append(me)
 
+        key = (r,g)
+        vars.group_size[key] = vars.GroupSum(r, g, everyone)
+        vars.num_participants[key] = vars.GroupSum(r, g, participants)
+        vars.num_leaders[key] = vars.GroupSum(r, g, index.is_leader)
+        vars.num_leaders_experienced[key] = vars.GroupSum(r, g, index.experienced)
+        vars.num_leaders_inexperienced[key] = vars.GroupSum(r, g, index.inexperienced)
+        vars.num_leaders_scouted[key] = vars.GroupSum(r, g, scouted)
+        vars.num_leaders_female[key] = vars.GroupSum(r, g, female_leaders)
+        vars.num_genders[key] = {'F': vars.GroupSum(r, g, index.female),
+                                 'M': vars.GroupSum(r, g, index.male)}
+
+        num_scouts_group = vars.num_leaders_scouted[key]
+        if isinstance(vars.group_size[key], int):
+          # The group is fixed (i.e. finalized), so whether it has a scout is
+          # too.
+          num_scout_groups.append(int(num_scouts_group >= 1))
+          continue
         group_has_scout = model.NewBoolVar(VarName('group_has_scout', [r, g]))
-        model.Add(sum(num_scouts_group) >= 1).OnlyEnforceIf(group_has_scout)
-        model.Add(sum(num_scouts_group) < 1).OnlyEnforceIf(group_has_scout.Not())
+        model.Add(num_scouts_group >= 1).OnlyEnforceIf(group_has_scout)
+        model.Add(num_scouts_group < 1).OnlyEnforceIf(group_has_scout.Not())
         num_scout_groups.append(group_has_scout)
-      vars.num_scout_groups[r] = sum(num_scout_groups)
+      vars.num_scout_groups[r] = Sum(num_scout_groups)
+
+    if sparse:
+      return
 
     # Constrain historical rosters to what they were.
-    prior_ride_true = set()
-    finalized = set()
-    for roster in self.prior_rosters:
-      if roster.finalized:
-        for rider in [self.riders.Rider(r) for r in roster.rider_ids]:
-          prior_ride_true.add((roster.ride, roster.group, rider.id))
-        finalized.add((roster.ride, roster.group))
-    for p in self.riders.AllRiders():
+    for (i, p) in enumerate(index.ids):
       for r in range(0, self.params.num_rides):
         for g in range(0, self.params.max_groups):
-          if (r,g,p.id) in prior_ride_true:
-            model.Add(vars.memberships[(r, g, p.id)] == 1)
+          if (r,g,p) in prior_ride_true:
+            model.Add(vars.membership_vars[r, g, i] == 1)
           else:
-            if r <= self.params.finalized_ride:# or (r,g) in finalized:
-                model.Add(vars.memberships[(r, g, p.id)] == 0)
+            if r <= self.params.finalized_ride:
+              model.Add(vars.membership_vars[r, g, i] == 0)
 
   def AddGroupConstraints(self, model, vars):
     """
@@ -224,10 +497,10 @@ class AlgorithmTM(object):
       model.AddMinEquality(target_scouts_groups, [self.num_available_scouts[r], vars.num_groups[r]])
       model.Add(vars.num_scout_groups[r] == target_scouts_groups)
       for g in range(0, self.params.max_groups):
-        group_size = sum(vars.groups[(r,g)])
+        group_size = vars.group_size[(r,g)]
         group_active = vars.group_active[(r,g)]
-        num_leaders = sum(vars.group_leaders[(r,g)])
-        num_participants = sum(vars.group_participants[(r,g)])
+        num_leaders = vars.num_leaders[(r,g)]
+        num_participants = vars.num_participants[(r,g)]
 
         # Make sure we're setting exactly num_groups for the given ride.
         too_many_groups = model.NewBoolVar(VarName('too_many_groups', [r, g]))
@@ -241,12 +514,12 @@ class AlgorithmTM(object):
 
         # Each group must have at least two leaders, and at least one
         # experienced leader.
-        model.Add(sum(vars.group_leaders[(r,g)]) >= 2).OnlyEnforceIf(group_active)
-        model.Add(sum(vars.group_leaders_experienced[(r,g)]) >= 1).OnlyEnforceIf(group_active)
+        model.Add(num_leaders >= 2).OnlyEnforceIf(group_active)
+        model.Add(vars.num_leaders_experienced[(r,g)] >= 1).OnlyEnforceIf(group_active)
 
         # No lone riders of either gender.
-        model.Add(sum(vars.groups_genders[(r,g)]['F']) != 1).OnlyEnforceIf(group_active)
-        model.Add(sum(vars.groups_genders[(r,g)]['M']) != 1).OnlyEnforceIf(group_active)
+        model.Add(vars.num_genders[(r,g)]['F'] != 1).OnlyEnforceIf(group_active)
+        model.Add(vars.num_genders[(r,g)]['M'] != 1).OnlyEnforceIf(group_active)
 
         # Hard limit on even group sizes / number of leaders.
         model.AddLinearConstraint(num_participants - vars.target_participants[r], 0, 1).OnlyEnforceIf(group_active)
@@ -258,26 +531,61 @@ class AlgorithmTM(object):
     #  for g1 in range(0, self.params.max_groups):
     #    for g2 in range(0, self.params.max_groups):
     #        g1_has_more_leaders = model.NewBoolVar(VarName('more_leaders', [r, g1, g2]))
-    #        model.Add(sum(vars.group_leaders[(r,g1)]) > sum(vars.group_leaders[(r,g2)])).OnlyEnforceIf(g1_has_more_leaders)
-    #        model.Add(sum(vars.group_leaders[(r,g1)]) <= sum(vars.group_leaders[(r,g2)])).OnlyEnforceIf(g1_has_more_leaders.Not())
-    #        model.Add(sum(vars.group_participants[(r,g1)]) >= sum(vars.group_participants[(r,g2)])).OnlyEnforceIf(g1_has_more_leaders)
+    #        model.Add(vars.num_leaders[(r,g1)] > vars.num_leaders[(r,g2)]).OnlyEnforceIf(g1_has_more_leaders)
+    #        model.Add(vars.num_leaders[(r,g1)] <= vars.num_leaders[(r,g2)]).OnlyEnforceIf(g1_has_more_leaders.Not())
+    #        model.Add(vars.num_participants[(r,g1)] >= vars.num_participants[(r,g2)]).OnlyEnforceIf(g1_has_more_leaders)
 
   def AddRiderConstraints(self, model, vars):
     # Make sure every rider is in exactly one group if they're attending the
     # ride and zero groups if they aren't.
+    index = self.index
     for r in range(self.params.start_ride, self.params.num_rides):
-      for p in self.riders.AllRiders():
-        s = 0
-        for g in range(0, self.params.max_groups):
-          s += vars.memberships[(r, g, p.id)]
-        model.Add(s == p.IsAvailable(r))
+      available = index.Available(r).tolist()
+      for (i, p) in enumerate(index.ids):
+        s = Sum([vars.Membership(r, g, p) for g in range(0, self.params.max_groups)])
+        if isinstance(s, int):
+          # Every slot is folded, e.g. a finalized roster on an open ride.
+          if s != available[i]:
+            raise ValueError('Rider %s is in %d finalized groups on ride %d but is %savailable' %
+                             (p, s, r, '' if available[i] else 'not '))
+          continue
+        model.Add(s == available[i])
 
     # Make sure participants that need a woman leader are assigned a group with one.
+    needs_woman_leader = [index.ids[i] for i in np.flatnonzero(index.needs_woman_leader)]
     for r in range(self.params.start_ride, self.params.num_rides):
-      for p in self.riders.AllRiders():
+      for p in needs_woman_leader:
         for g in range(0, self.params.max_groups):
-          if p.NeedsWomanLeader():
-            model.Add(sum(vars.group_leaders_female[(r,g)]) > 0).OnlyEnforceIf(vars.memberships[(r,g,p.id)])
+          me = vars.Membership(r, g, p)
+          if isinstance(me, int):
+            if me:
+              model.Add(vars.num_leaders_female[(r,g)] > 0)
+            continue
+          model.Add(vars.num_leaders_female[(r,g)] > 0).OnlyEnforceIf(me)
+
+  def AddSymmetryBreaking(self, model, vars):
+    '''
+    Groups on a ride are interchangeable, so order them lexicographically by
+    leader: experienced leaders come first, and a leader may only be in group
+    g if a leader earlier in that order is in group g-1.  Every active group
+    has a leader, so any roster can be relabeled to satisfy this.  Rides with
+    finalized rosters have fixed group numbers and are left alone.
+    '''
+    finalized = set(r.ride for r in self.prior_rosters if r.finalized)
+    index = self.index
+    leaders = sorted(index.leaders.tolist(),
+                     key=lambda i: (not index.experienced[i], index.ids[i]))
+    for r in range(self.params.start_ride, self.params.num_rides):
+      if r <= self.params.finalized_ride or r in finalized:
+        continue
+      ordered = [index.ids[i] for i in leaders if self.can_ride[r, i]]
+      for i, p in enumerate(ordered):
+        # The i-th leader can't be in a group past i.
+        for g in range(i + 1, self.params.max_groups):
+          model.Add(vars.Membership(r, g, p) == 0)
+        for g in range(1, min(i + 1, self.params.max_groups)):
+          earlier = [vars.Membership(r, g - 1, q) for q in ordered[:i]]
+          model.AddBoolOr(earlier).OnlyEnforceIf(vars.Membership(r, g, p))
 
   def OptimizeGroupSize(self, model, vars):
     '''
@@ -285,39 +593,58 @@ class AlgorithmTM(object):
     not too big.
     '''
     penalties = []
+    weights = []
     for r in range(self.params.start_ride, self.params.num_rides):
       # Have the minimum number of target_leaders for each group.
       model.Add(vars.target_leaders[r] >= 2)
 
       # Don't have too many target leaders.
-      leader_penalty = model.NewIntVar(0, len(self.riders.AllLeaders()),
+      leader_penalty = model.NewIntVar(0, self.num_leaders,
                                        VarName('leader_penalty', [r]))
       model.AddAbsEquality(leader_penalty, vars.target_leaders[r] - 2)
       penalties.append(leader_penalty)
+      weights.append(1)
 
       # Don't stray too far from 4 target participants.
-      participant_penalty = model.NewIntVar(0, len(self.riders.AllParticipants()) + 4,
+      participant_penalty = model.NewIntVar(0, self.num_participants + 4,
                                             VarName('participant_penalty', [r]))
       model.AddAbsEquality(participant_penalty, vars.target_participants[r] - 4)
-      penalties.append(100*participant_penalty)
-      participant_penalty2 = model.NewIntVar(0, len(self.riders.AllParticipants()) + 3,
+      penalties.append(participant_penalty)
+      weights.append(100)
+      participant_penalty2 = model.NewIntVar(0, self.num_participants + 3,
                                             VarName('participant_penalty2', [r]))
       model.AddAbsEquality(participant_penalty2, vars.target_participants[r] - 3)
-      penalties.append(100*participant_penalty2)
+      penalties.append(participant_penalty2)
+      weights.append(100)
 
       # Penalize groups that stray too far from target_participants.
       for g in range(0, self.params.max_groups):
-        num_participants = sum(vars.group_participants[(r,g)])
+        num_participants = vars.num_participants[(r,g)]
         group_active = vars.group_active[(r,g)]
 
-        penalty = model.NewIntVar(0, len(self.riders.AllParticipants()), VarName('num_participants_penalty', [r, g]))
+        penalty = model.NewIntVar(0, self.num_participants, VarName('num_participants_penalty', [r, g]))
         model.AddAbsEquality(penalty, num_participants - vars.target_participants[r])
-        penalty2 = model.NewIntVar(0, len(self.riders.AllParticipants()), VarName('num_participants_penalty2', [r, g]))
+        penalty2 = model.NewIntVar(0, self.num_participants, VarName('num_participants_penalty2', [r, g]))
         model.Add(penalty2 == penalty).OnlyEnforceIf(group_active)
         model.Add(penalty2 == 0).OnlyEnforceIf(group_active.Not())
         penalties.append(penalty2)
+        weights.append(1)
 
-    model.Minimize(sum(penalties))
+    model.Minimize(cp_model.LinearExpr.WeightedSum(penalties, weights))
+
+  def GroupOf(self, model, vars, r, p):
+    '''
+    Returns an int variable for the group rider p is in on ride r, channeled
+    from their memberships.  Only meaningful when p rides r.
+    '''
+    key = (r, p)
+    if key not in vars.group_of:
+      x = model.NewIntVar(0, self.params.max_groups - 1, VarName('group_of', [r, p]))
+      groups = range(1, self.params.max_groups)
+      model.Add(x == cp_model.LinearExpr.WeightedSum(
+          [vars.Membership(r, g, p) for g in groups], list(groups)))
+      vars.group_of[key] = x
+    return vars.group_of[key]
 
   def OptimizePairings(self, model, vars):
     '''
@@ -325,18 +652,14 @@ class AlgorithmTM(object):
     '''
     # Compute the set of all possible pairs of riders, and then we try to
     # optimize for including as many pairs as possible in the rosters.
-    all_pairs = set()
-    for p1 in self.riders.AllRiders():
-      for p2 in self.riders.AllRiders():
-        if (p1.id != p2.id and (p2.id, p1.id) not in all_pairs):
-          all_pairs.add((p1.id, p2.id))
-    print("Number of riders: ", len(self.riders.AllRiders()))
+    index = self.index
+    n = len(index)
+    all_pairs = [(i, j) for i in range(0, n) for j in range(i + 1, n)]
+    print("Number of riders: ", n)
     print("Number of total rider pairings: ", len(all_pairs))
     print()
     assert(math.isclose(len(all_pairs),
-           math.factorial(len(self.riders.AllRiders()))/
-           math.factorial(2)/
-           math.factorial(len(self.riders.AllRiders())-2)))
+           math.factorial(n)/math.factorial(2)/math.factorial(n-2)))
 
     # For each pair of riders we create a boolean that represents if these
     # riders have ridden together.
@@ -344,78 +667,137 @@ class AlgorithmTM(object):
     # We also account for a match score (hand curated) for some pairs of riders.
     # These are used as the coefficient on the paired boolean to compute a score
     # for the roster.
-    def MentorPair(i1, i2):
-      p1 = self.riders.Rider(i1)
-      p2 = self.riders.Rider(i2)
-      if p1.IsLeader() == p2.IsLeader():
-        return False
-      if p1.IsLeader():
-        return p2.mentor == p1.id
-      if p2.IsLeader():
-        return p1.mentor == p2.id
+    #
+    # Mentors and mentees must ride together on their ride in mentor_rides, a
+    # map from (i1, i2) -> ride.
+    mentor_rides = dict(((min(i, j), max(i, j)), r)
+                        for (j, (i, r)) in index.mentees.items())
 
+    # The objective is the weighted sum of scores, plus the paired variables.
     scores = []
+    weights = []
 
     # Penalize groups where an inexperienced leader isn't with 2 other leaders.
     for r in range(0, self.params.num_rides):
-      scores.append(100*vars.num_scout_groups[r])
+      scores.append(vars.num_scout_groups[r])
+      weights.append(100)
       for g in range(0, self.params.max_groups):
-        inexperienced = sum(vars.group_leaders_inexperienced[(r,g)])
-        num_leaders = sum(vars.group_leaders[(r,g)])
+        inexperienced = vars.num_leaders_inexperienced[(r,g)]
+        num_leaders = vars.num_leaders[(r,g)]
         group_active = vars.group_active[(r,g)]
 
-        penalty = model.NewIntVar(-2, len(self.riders.AllLeaders()), VarName('inexperienced_leader_penalty', [r, g]))
+        if isinstance(vars.group_size[(r,g)], int):
+          # Fixed (i.e. finalized) groups only add a constant.
+          if vars.group_size[(r,g)]:
+            scores.append(abs(num_leaders - inexperienced - 2))
+            weights.append(-200)
+          continue
+
+        penalty = model.NewIntVar(-2, self.num_leaders, VarName('inexperienced_leader_penalty', [r, g]))
         model.AddAbsEquality(penalty, num_leaders - inexperienced - 2)
 
-        penalty2 = model.NewIntVar(-2, len(self.riders.AllLeaders()), VarName('inexperienced_leader_penalty2', [r, g]))
+        penalty2 = model.NewIntVar(-2, self.num_leaders, VarName('inexperienced_leader_penalty2', [r, g]))
         model.Add(penalty2 == penalty).OnlyEnforceIf(group_active)
         model.Add(penalty2 == 0).OnlyEnforceIf(group_active.Not())
-        scores.append(-200*penalty2)
-
-    for (p1, p2) in all_pairs:
-      vars.paired[(p1, p2)] = model.NewBoolVar(VarName('paired', [p1, p2]))
-      p1_obj = self.riders.Rider(p1)
-      p2_obj = self.riders.Rider(p2)
+        scores.append(penalty2)
+        weights.append(-200)
+
+    # Pair variables are only needed on open rides both riders can attend.
+    # Finalized rides contribute the pairs that already happened and their
+    # scores as constants, and pairs that can never ride together are left out
+    # of the objective.
+    finalized_pairs = self.FinalizedPairs()
+    assignment = self.params.pairing_encoding == 'assignment'
+    num_pruned_pairs = 0
+    num_already_paired = 0
+    num_pruned_paired_at = 0
+    available = index.Available
+    for (i1, i2) in all_pairs:
+      p1 = index.ids[i1]
+      p2 = index.ids[i2]
+
+      history = finalized_pairs.get((p1, p2), set())
+      open_rides = np.flatnonzero(self.can_ride[:, i1] & self.can_ride[:, i2]).tolist()
+      num_pruned_paired_at += (self.params.max_groups *
+                               (self.params.num_rides - len(open_rides)))
+      if not open_rides and not history:
+        num_pruned_pairs += 1
+        continue
 
       paired_in_group = []
-      not_paired_in_group = []
-      for r in range(0, self.params.num_rides):
+      already_paired = len(history) > 0
+      for r in history:
+        scores.append(1)
+        weights.append(int(self.pair_weights[r, i1, i2]))
+      for r in open_rides:
         paired_on_ride = []
-        for g in range(0, self.params.max_groups):
-          paired_here = model.NewBoolVar(VarName('paired_at', [p1, p2, r, g]))
-          pair = [vars.memberships[(r, g, p1)], vars.memberships[(r, g, p2)]]
-          not_pair = [vars.memberships[(r, g, p1)].Not(), vars.memberships[(r, g, p2)].Not()]
-          model.AddBoolAnd(pair).OnlyEnforceIf(paired_here)
-          model.AddBoolOr(not_pair).OnlyEnforceIf(paired_here.Not())
-
+        if assignment and r >= self.params.start_ride:
+          # Both riders are in exactly one group, so they're paired when their
+          # group numbers match.
+          paired_here = model.NewBoolVar(VarName('paired_on', [p1, p2, r]))
+          x1 = self.GroupOf(model, vars, r, p1)
+          x2 = self.GroupOf(model, vars, r, p2)
+          model.Add(x1 == x2).OnlyEnforceIf(paired_here)
+          model.Add(x1 != x2).OnlyEnforceIf(paired_here.Not())
           paired_in_group.append(paired_here)
-          not_paired_in_group.append(paired_here.Not())
-
           paired_on_ride.append(paired_here)
+        else:
+          for g in range(0, self.params.max_groups):
+            m1 = vars.MembershipAt(r, g, i1)
+            m2 = vars.MembershipAt(r, g, i2)
+            if isinstance(m1, int) and isinstance(m2, int):
+              # Both memberships are folded constants (i.e. finalized).
+              if m1 and m2:
+                already_paired = True
+                paired_on_ride.append(1)
+              continue
+            if isinstance(m1, int) or isinstance(m2, int):
+              # One rider is fixed in the group, so the pair is just the other.
+              fixed, other = (m1, m2) if isinstance(m1, int) else (m2, m1)
+              if not fixed:
+                continue
+              paired_here = other
+            else:
+              paired_here = model.NewBoolVar(VarName('paired_at', [p1, p2, r, g]))
+              model.AddBoolAnd([m1, m2]).OnlyEnforceIf(paired_here)
+              model.AddBoolOr([m1.Not(), m2.Not()]).OnlyEnforceIf(paired_here.Not())
+
+            paired_in_group.append(paired_here)
+            paired_on_ride.append(paired_here)
+
+        # Force mentor/mentee pairings on the first ride from ride 2 onwards
+        # they're both on.
+        if r >= self.params.start_ride and mentor_rides.get((i1, i2)) == r:
+          print('Adding ride %d mentor constraint for'%r,
+                index.riders[i1].name, index.riders[i2].name)
+          model.AddBoolOr(paired_on_ride)
+
+        if self.together[r, i1, i2]:
+            print('Adding ride %d bonus for'%r, index.riders[i1].name, index.riders[i2].name)
+
+        # Score the pair's match score and together bonus.
+        weight = int(self.pair_weights[r, i1, i2])
+        if weight:
+          scores.extend(paired_on_ride)
+          weights.extend([weight] * len(paired_on_ride))
+
+      # Pairs that already rode together count as a constant.
+      if already_paired:
+        num_already_paired += 1
+        continue
+      vars.paired[(p1, p2)] = model.NewBoolVar(VarName('paired', [p1, p2]))
 
-        # For ride 2 force mentor/mentee pairings.
-        for mr in range(1, self.params.num_rides):
-            not_previously_available = True
-            for mrp in range(1, mr):
-                not_previously_available = (not_previously_available and
-                    (not p1_obj.IsAvailable(mrp) or not p2_obj.IsAvailable(mrp)))
-            if (r >= self.params.start_ride and
-                r == mr and MentorPair(p1, p2) and
-                p1_obj.IsAvailable(r) and p2_obj.IsAvailable(r) and
-                not_previously_available):
-              print('Adding ride %d mentor constraint for'%r, p1_obj.name, p2_obj.name)
-              model.AddBoolOr(paired_on_ride)
-
-        ride = self.rides[r]
-        if (p1_obj.IsAvailable(r) and p2_obj.IsAvailable(r) and
-            ride.PairRidersTogether(p1, p2)):
-            print('Adding ride %d bonus for'%r, p1_obj.name, p2_obj.name)
-            scores.append(1000 * sum(paired_on_ride))
-
-        # Augment scores with match scores
-        scores.append(self.riders.GetMatchScore(p1, p2) * sum(paired_on_ride))
-
-      if not p1_obj.Ignore() and not p2_obj.Ignore():
+      # Pairs with no chance to ride together after the modeled rides count
+      # double, so the window doesn't spend later opportunities now.
+      if self.params.lookahead_rides > 0:
+        later = range(self.params.num_rides,
+                      self.params.num_rides + self.params.lookahead_rides)
+        if not any(available(r)[i1] and available(r)[i2] for r in later):
+          scores.append(vars.paired[(p1, p2)])
+          weights.append(1)
+
+      if not index.ignore[i1] and not index.ignore[i2]:
+        not_paired_in_group = [x.Not() for x in paired_in_group]
         model.AddBoolOr(paired_in_group).OnlyEnforceIf(vars.paired[(p1, p2)])
         model.AddBoolAnd(not_paired_in_group).OnlyEnforceIf(vars.paired[(p1, p2)].Not())
 
@@ -425,11 +807,24 @@ class AlgorithmTM(object):
       #model.AddAbsEquality(bonus_pairs, 1 - sum(paired_in_group))
       #scores.append(-10*bonus_pairs)
 
-    model.Maximize(sum(vars.paired.values()) + sum(scores))
+    print('Pruned %d of %d paired variables (riders never available together)' %
+          (num_pruned_pairs, len(all_pairs)))
+    print('Folded %d of %d paired variables (riders already paired)' %
+          (num_already_paired, len(all_pairs)))
+    print('Pruned %d of %d paired_at variables (unavailable or finalized rides)' %
+          (num_pruned_paired_at,
+           len(all_pairs) * self.params.num_rides * self.params.max_groups))
+    print()
+
+    scores.extend(vars.paired.values())
+    weights.extend([1] * len(vars.paired))
+    model.Maximize(cp_model.LinearExpr.WeightedSum(scores, weights) +
+                   num_already_paired)
 
   def BuildBaseModel(self, vars):
     model = cp_model.CpModel()
-    self.InitializeModel(model, vars)
+    with self.profiler.Phase('InitializeModel', model):
+      self.InitializeModel(model, vars)
 
     # Make sure that every ride has at least one group.
     for r in range(0, self.params.num_rides):
@@ -439,12 +834,39 @@ class AlgorithmTM(object):
           bools.append(vars.group_active[k])
       model.AddBoolOr(bools)
 
-    self.AddGroupConstraints(model, vars)
-    self.AddRiderConstraints(model, vars)
+    with self.profiler.Phase('AddGroupConstraints', model):
+      self.AddGroupConstraints(model, vars)
+    with self.profiler.Phase('AddRiderConstraints', model):
+      self.AddRiderConstraints(model, vars)
+    if self.params.symmetry_breaking:
+      with self.profiler.Phase('AddSymmetryBreaking', model):
+        self.AddSymmetryBreaking(model, vars)
     return model
 
+  def NewSolver(self, profile):
+    '''
+    Returns a CpSolver with the time limit and the given solver profile applied.
+    '''
+    solver = cp_model.CpSolver()
+    solver.parameters.log_search_progress = True
+    solver.parameters.max_time_in_seconds = self.params.time_limit
+    for (name, value) in profile.items():
+      if isinstance(value, list):
+        field = getattr(solver.parameters, name)
+        del field[:]
+        field.extend(value)
+      else:
+        setattr(solver.parameters, name, value)
+    return solver
+
   def SolveAndLog(self, solver, printer, model, vars):
-    status = solver.Solve(model, printer)
+    with self.profiler.Phase('Solve', model) as record:
+      status = solver.Solve(model, printer)
+      record['status'] = solver.StatusName(status)
+      record['objective'] = solver.ObjectiveValue()
+      record['bound'] = solver.BestObjectiveBound()
+      record['conflicts'] = solver.NumConflicts()
+      record['branches'] = solver.NumBranches()
     print(f'Maximum of objective function: {solver.ObjectiveValue()}\n')
     print('\nStatistics')
     print(f'  status   : {solver.StatusName(status)}')
@@ -458,17 +880,44 @@ class AlgorithmTM(object):
       print('No solution found.')
       return None
 
-  def Solve(self):
+  def CacheKeys(self):
+    '''
+    Returns (pass 1 key, pass 2 key) hashing the inputs each pass depends on.
+    Draft rosters only matter when warm starting, and roster record ids never
+    matter.  Cached hints are indexed by rider position, so the order of the
+    rider index is part of the keys too.
+    '''
+    rosters = [(r.ride, r.group, r.finalized, sorted(r.rider_ids))
+               for r in self.prior_rosters
+               if r.finalized or self.params.warm_start]
+    riders = sorted(self.riders.rider_map.values(), key=lambda x: x.id)
+    rides = [(r, self.rides[r].airtable_id) for r in sorted(self.rides)]
+    pairings_params = ('pairings_solver', 'engine', 'local_search_time',
+                       'local_search_presolve', 'pairing_encoding')
+    groups_params = dict((k, v) for (k, v) in vars(self.params).items()
+                         if k not in pairings_params)
+    groups_key = HashInputs(MODEL_VERSION, self.index.ids, riders, rides,
+                            sorted(rosters), groups_params)
+    together = [(r, self.rides[r].together) for r in sorted(self.rides)]
+    pairings_key = HashInputs(MODEL_VERSION, groups_key, self.riders.matches,
+                              together, self.params)
+    return ('groups-' + groups_key, 'pairings-' + pairings_key)
+
+  def SolveGroupSize(self):
+    '''
+    Runs pass 1 and returns the hints that fix the group topology for pass 2.
+    '''
     print('Optimizing group size...')
 
     vars = Vars()
     model = self.BuildBaseModel(vars)
-    self.OptimizeGroupSize(model, vars)
+    with self.profiler.Phase('OptimizeGroupSize', model):
+      self.OptimizeGroupSize(model, vars)
+    if self.params.warm_start and self.params.warm_start_topology:
+      vars.AddHints(model, self.DraftHints(vars.membership_index >= 0))
     print(model.ModelStats())
-    printer = Printer(vars, self.riders)
-    solver = cp_model.CpSolver()
-    solver.parameters.log_search_progress = True
-    solver.parameters.max_time_in_seconds = self.params.time_limit
+    printer = self.printer(vars, self.riders)
+    solver = self.NewSolver(self.params.group_size_solver)
 
     results = self.SolveAndLog(solver, printer, model, vars)
     if results is None:
@@ -481,31 +930,143 @@ class AlgorithmTM(object):
       print('Ride %d >> %d num_groups : target_participants %d and target_leaders %d' %
             (k+1, solver.Value(vn), solver.Value(vs), solver.Value(vl)))
       for g in range(0, self.params.max_groups):
-          num_leaders = sum(solver.Value(x) for x in vars.group_leaders[(k,g)])
-          num_participants = sum(solver.Value(x) for x in vars.group_participants[(k,g)])
+          num_leaders = solver.Value(vars.num_leaders[(k,g)])
+          num_participants = solver.Value(vars.num_participants[(k,g)])
           print('  Group %d -- %d leaders and %d participants' %
                 (g, num_leaders, num_participants))
 
-    hints = vars.RecordHints(solver)
+    return vars.RecordHints(solver)
+
+  def SolvePairings(self, hints):
+    '''
+    Runs pass 2 within the topology in hints and returns the memberships.
+    '''
     print()
     print('Optimzing pairings...')
     vars = Vars()
     model = self.BuildBaseModel(vars)
     vars.RestoreHints(model, hints)
-    self.OptimizePairings(model, vars)
+    with self.profiler.Phase('OptimizePairings', model):
+      self.OptimizePairings(model, vars)
     print(model.ModelStats())
 
-    printer = Printer(vars, self.riders)
-    solver = cp_model.CpSolver()
-    solver.parameters.log_search_progress = True
-    solver.parameters.max_time_in_seconds = self.params.time_limit
+    printer = self.printer(vars, self.riders)
+    solver = self.NewSolver(self.params.pairings_solver)
 
     results = self.SolveAndLog(solver, printer, model, vars)
     if results is None:
       return
 
-    memberships = []
-    for (k,v) in vars.memberships.items():
-      if (solver.Value(v)):
-        memberships.append(k)
+    return vars.SelectedMemberships(SolutionValues(solver.ResponseProto()))
+
+  def SolveRollingHorizon(self):
+    '''
+    Solves params.horizon rides at a time.  Each window treats everything
+    committed so far as finalized history and the rides after it as lookahead,
+    then commits its first params.horizon_step rides and slides forward.  The
+    time limits are split evenly across the windows.
+    '''
+    if not 1 <= self.params.horizon_step <= self.params.horizon:
+      raise ValueError('horizon_step must be between 1 and horizon (%d), not %d' %
+                       (self.params.horizon, self.params.horizon_step))
+
+    # Map from the first ride of each window -> (its end, the first ride of the
+    # next window).  The last window commits all of its rides.
+    windows = OrderedDict()
+    w = self.params.start_ride
+    while w < self.params.num_rides:
+      end = min(w + self.params.horizon, self.params.num_rides)
+      if end == self.params.num_rides:
+        windows[w] = (end, end)
+      else:
+        windows[w] = (end, min(w + self.params.horizon_step, end))
+      w = windows[w][1]
+
+    start = time.time()
+    committed = [r for r in self.prior_rosters if r.finalized]
+    drafts = [r for r in self.prior_rosters if not r.finalized]
+    rosters = []
+    for (w, (end, last)) in windows.items():
+      params = copy.copy(self.params)
+      params.horizon = 0
+      params.start_ride = w
+      params.finalized_ride = w - 1
+      params.num_rides = end
+      params.lookahead_rides = self.params.num_rides - end
+      params.time_limit = self.params.time_limit / len(windows)
+      params.local_search_time = self.params.local_search_time / len(windows)
+      print('Rolling horizon window: rides %d to %d' % (w, end - 1))
+      window = AlgorithmTM(self.riders, list(self.rides.values()),
+                           committed + drafts, params, self.cache, self.profiler,
+                           self.printer)
+      with self.profiler.Section('window %d-%d' % (w, end - 1)):
+        window_rosters = window.Solve()
+      if window_rosters is None:
+        return
+
+      for roster in window_rosters:
+        if roster.ride < self.params.start_ride:
+          # Like Solve, include the finalized rides, which are the same in
+          # every window.
+          if w == self.params.start_ride:
+            rosters.append(roster)
+        elif w <= roster.ride < last:
+          rosters.append(roster)
+          committed.append(Roster(self.riders, roster.id, roster.ride,
+                                  roster.group, roster.rider_ids, True))
+    print('Rolling horizon solve took %.1f s' % (time.time() - start))
+    return rosters
+
+  def Solve(self):
+    if self.params.horizon:
+      return self.SolveRollingHorizon()
+
+    groups_key = pairings_key = None
+    if self.cache:
+      (groups_key, pairings_key) = self.CacheKeys()
+      memberships = self.cache.Get(pairings_key)
+      if memberships is not None:
+        print('Inputs are unchanged, using cached rosters %s' % pairings_key)
+        return self.GetRosters(memberships)
+
+    hints = None
+    if self.cache:
+      hints = self.cache.Get(groups_key)
+      if hints is not None:
+        print('Group inputs are unchanged, using cached topology %s' % groups_key)
+    if hints is None:
+      with self.profiler.Section('group_size'):
+        hints = self.SolveGroupSize()
+      if hints is None:
+        return
+      if self.cache:
+        self.cache.Put(groups_key, hints)
+
+    with self.profiler.Section('pairings'):
+      # The draft rosters take precedence over the pass 1 memberships, and are
+      # applied before LocalSearch so that it starts from them and its result
+      # is what hints CP-SAT.
+      if self.params.warm_start:
+        hints = self.ApplyDraftHints(hints)
+      if self.params.engine == 'local' or self.params.local_search_presolve:
+        with self.profiler.Phase('LocalSearch'):
+          search = LocalSearch(self, hints)
+          search.Run(self.params.local_search_time)
+        hints = search.Hints()
+      memberships = None
+      if self.params.engine == 'local':
+        violations = search.Violations()
+        if violations == 0:
+          memberships = search.Memberships()
+        else:
+          # The search starts from pass 1, which doesn't know about e.g.
+          # mentor pairings, so it may not have found a feasible roster.
+          print('Local search left %d constraints violated, falling back to CP-SAT' %
+                violations)
+      if memberships is None:
+        memberships = self.SolvePairings(hints)
+    if memberships is None:
+      return
+    if self.cache:
+      self.cache.Put(pairings_key, memberships)
     return self.GetRosters(memberships)
@@ -0,0 +1,71 @@
+import contextlib
+import datetime
+import json
+import resource
+import time
+
+def PeakRssKb():
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class Profiler(object):
+    '''
+    Records wall time, peak RSS and model growth for each phase of a run.
+    Phases are labeled with the sections (e.g. pass or window) they ran in.
+    '''
+    def __init__(self):
+        self.started = datetime.datetime.now()
+        self.start = time.time()
+        self.sections = []
+        self.phases = []
+
+    @contextlib.contextmanager
+    def Section(self, name):
+        self.sections.append(name)
+        try:
+            yield
+        finally:
+            self.sections.pop()
+
+    @contextlib.contextmanager
+    def Phase(self, name, model=None):
+        '''
+        Times the enclosed block.  The yielded dict is the phase's record, which
+        callers can add results (e.g. solver status) to.
+        '''
+        record = {'section': '/'.join(self.sections), 'phase': name}
+        if model is not None:
+            proto = model.Proto()
+            variables = len(proto.variables)
+            constraints = len(proto.constraints)
+        start = time.time()
+        try:
+            yield record
+        finally:
+            record['wall_time'] = time.time() - start
+            record['peak_rss_kb'] = PeakRssKb()
+            if model is not None:
+                record['variables_added'] = len(proto.variables) - variables
+                record['constraints_added'] = len(proto.constraints) - constraints
+            self.phases.append(record)
+
+    def Report(self):
+        return {
+            'started': self.started.isoformat(),
+            'total_time': time.time() - self.start,
+            'peak_rss_kb': PeakRssKb(),
+            'phases': self.phases,
+        }
+
+    def Print(self):
+        print('%-28s %-20s %9s %10s %12s %12s' % ('section', 'phase', 'time (s)',
+              'rss (MB)', 'variables', 'constraints'))
+        for p in self.phases:
+            print('%-28s %-20s %9.2f %10.1f %12s %12s' % (
+                p['section'], p['phase'], p['wall_time'], p['peak_rss_kb'] / 1024,
+                p.get('variables_added', ''), p.get('constraints_added', '')))
+
+    def Write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.Report(), f, indent=2)
+        print('Wrote profile to %s' % path)
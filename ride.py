@@ -1,4 +1,7 @@
 from datetime import datetime
+
+import numpy as np
+
 from sig_groups.rider import Leader, Participant
 
 class Ride(object):
@@ -21,6 +24,17 @@ class Ride(object):
     def PairRidersTogether(self, p1, p2):
         return (p1, p2) in self.together
 
+    def TogetherMatrix(self, index):
+        '''
+        Returns PairRidersTogether for every pair of riders in the RiderIndex
+        index as a boolean matrix indexed by position.
+        '''
+        together = np.zeros((len(index), len(index)), dtype=bool)
+        for (p1, p2) in self.together:
+            if p1 in index.position and p2 in index.position and p1 != p2:
+                together[index.position[p1], index.position[p2]] = True
+        return together
+
 class Roster(object):
     def __init__(self, rider_data, id, ride, group, rider_ids, finalized=False):
         self.rider_data = rider_data
@@ -98,3 +112,46 @@ class Rosters(object):
                 "alt_text": "Algorithm status for ride {self.ride + 1}",
             })
         return blocks
+
+class RosterDiff(object):
+    '''
+    Compares new rosters against the prior rosters of the same rides by ride,
+    group and set of riders.
+    '''
+    def __init__(self, rosters, prior_rosters, rides):
+        rides = set(rides)
+        new = dict(((r.ride, r.group), r) for r in rosters if r.ride in rides)
+        prior = dict(((r.ride, r.group), r) for r in prior_rosters if r.ride in rides)
+
+        self.added = []
+        self.changed = []
+        self.unchanged = []
+        self.removed = [prior[k] for k in sorted(prior) if k not in new]
+        for k in sorted(new):
+            if k not in prior:
+                self.added.append(new[k])
+            elif set(new[k].rider_ids) != set(prior[k].rider_ids):
+                self.changed.append(new[k])
+            else:
+                self.unchanged.append(new[k])
+        self.prior = prior
+
+    def Writes(self):
+        return self.added + self.changed
+
+    def ChangedRides(self):
+        return sorted(set(r.ride for r in self.added + self.changed + self.removed))
+
+    def Print(self):
+        for roster in self.added:
+            print('Ride %d Group %d: added' % (roster.ride + 1, roster.group + 1))
+        for roster in self.removed:
+            print('Ride %d Group %d: removed' % (roster.ride + 1, roster.group + 1))
+        for roster in self.changed:
+            old = set(self.prior[(roster.ride, roster.group)].rider_ids)
+            new = set(roster.rider_ids)
+            names = lambda ids: ', '.join(sorted(roster.rider_data.Rider(p).name for p in ids))
+            print('Ride %d Group %d: +[%s] -[%s]' % (roster.ride + 1, roster.group + 1,
+                  names(new - old), names(old - new)))
+        print('Rosters: %d added, %d changed, %d removed, %d unchanged' %
+              (len(self.added), len(self.changed), len(self.removed), len(self.unchanged)))
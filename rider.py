@@ -1,6 +1,8 @@
 from collections import defaultdict
 from enum import Enum
 
+import numpy as np
+
 class Rider(object):
   def __init__(self, id, name):
     self.id = id
@@ -82,6 +84,16 @@ class RiderData(object):
       self.rider_map[x.id] = x
 
     self.matches = {}  # map from (id, id) -> Match
+    self.index = None
+
+  def Index(self):
+    '''
+    Returns the RiderIndex of AllRiders, built on first use.  Riders must not
+    change after that.
+    '''
+    if self.index is None:
+      self.index = RiderIndex(self.AllRiders())
+    return self.index
 
   def AllRiders(self):
     return [x for x in self.rider_map.values() if x.NumAvailableRides() > 0]
@@ -116,6 +128,18 @@ class RiderData(object):
         result.append(v)
     return result
 
+  def MatchScores(self):
+    '''
+    Returns GetMatchScore for every pair of riders as a matrix indexed by
+    Index() positions.
+    '''
+    index = self.Index()
+    scores = np.ones((len(index), len(index)), dtype=np.int32)
+    for ((p1, p2), m) in self.matches.items():
+      if p1 in index.position and p2 in index.position:
+        scores[index.position[p1], index.position[p2]] = m.score
+    return scores
+
   def GetMatchScore(self, p1, p2):
     try:
       return self.matches[(p1, p2)].score
@@ -133,6 +157,83 @@ class RiderData(object):
   def Rider(self, id):
     return self.rider_map[id]
 
+class RiderIndex(object):
+  '''
+  An immutable dense integer index over riders, with their attributes as
+  read-only NumPy arrays indexed by position.
+  '''
+  def __init__(self, riders):
+    self.riders = tuple(riders)
+    self.ids = tuple(p.id for p in self.riders)
+    self.position = dict((id, i) for (i, id) in enumerate(self.ids))
+    self.genders = tuple(p.gender for p in self.riders)
+    n = len(self.riders)
+
+    def Array(values, dtype=bool):
+      a = np.array(list(values), dtype=dtype).reshape(-1)
+      a.flags.writeable = False
+      return a
+
+    self.is_leader = Array(p.IsLeader() for p in self.riders)
+    # Leader.Type values, or 0 for participants.
+    self.leader_type = Array((p.type.value if p.IsLeader() else 0 for p in self.riders), np.int8)
+    self.experienced = Array(self.leader_type == Leader.Type.EXPERIENCED.value)
+    self.inexperienced = Array(self.leader_type == Leader.Type.INEXPERIENCED.value)
+    self.female = Array(g == 'F' for g in self.genders)
+    self.male = Array(g == 'M' for g in self.genders)
+    self.needs_woman_leader = Array(p.NeedsWomanLeader() for p in self.riders)
+    self.ignore = Array(p.Ignore() for p in self.riders)
+    self.num_available_rides = Array((p.NumAvailableRides() for p in self.riders), np.int32)
+    # Position of each participant's mentor, or -1.
+    self.mentor = Array((self.position.get(getattr(p, 'mentor', None), -1)
+                         for p in self.riders), np.int32)
+
+    # Map from ride -> riders available, and airtable ride id -> leaders who
+    # scouted it.
+    num_rides = max([max(p.availability) + 1 for p in self.riders if p.availability] + [0])
+    available = np.zeros((num_rides, n), dtype=bool)
+    scouted = {}
+    for (i, p) in enumerate(self.riders):
+      available[list(p.availability), i] = True
+      for ride in getattr(p, 'scouted', ()):
+        scouted.setdefault(ride, np.zeros(n, dtype=bool))[i] = True
+    available.flags.writeable = False
+    for a in scouted.values():
+      a.flags.writeable = False
+    self.available = available
+    self.scouted = scouted
+    self.none = Array([False] * n)
+
+    # Map from participant position -> (mentor position, ride) for participants
+    # mentored by a leader, where ride is the first ride from the second
+    # onwards that they are both available for.
+    self.mentees = {}
+    for j in np.flatnonzero((self.mentor >= 0) & ~self.is_leader).tolist():
+      i = int(self.mentor[j])
+      shared = np.flatnonzero(available[1:, i] & available[1:, j])
+      if self.is_leader[i] and len(shared) > 0:
+        self.mentees[j] = (i, int(shared[0]) + 1)
+
+    self.leaders = Array(np.flatnonzero(self.is_leader), np.int32)
+    self.participants = Array(np.flatnonzero(~self.is_leader), np.int32)
+
+  def __len__(self):
+    return len(self.riders)
+
+  def Available(self, r):
+    '''
+    Returns whether each rider is available for ride r.
+    '''
+    if 0 <= r < len(self.available):
+      return self.available[r]
+    return self.none
+
+  def Scouted(self, ride_id):
+    '''
+    Returns whether each rider scouted the ride with airtable id ride_id.
+    '''
+    return self.scouted.get(ride_id, self.none)
+
 class Match(object):
   def __init__(self, p1, p2):
     self.p1 = p1
@@ -0,0 +1,60 @@
+import datetime
+import json
+import os
+
+from sig_groups.cache import CACHE_ROOT, MakePrivateDir
+
+DEFAULT_SNAPSHOT_DIR = os.path.join(CACHE_ROOT, 'snapshot')
+
+# Records modified this long before a sync started are fetched again by the
+# next sync, to allow for clock skew between us and Airtable.
+SYNC_OVERLAP = datetime.timedelta(minutes=5)
+
+class SnapshotStore(object):
+    '''
+    A directory of JSON snapshots of Airtable tables, one file per base and
+    table, recording the records, the fields they were loaded with and when
+    they were last synced.
+    '''
+    def __init__(self, path=DEFAULT_SNAPSHOT_DIR):
+        self.path = path
+
+    def _Path(self, base, table):
+        return os.path.join(self.path, base, '%s.json' % table)
+
+    def Load(self, base, table):
+        '''
+        Returns the snapshot of table as a dict with 'synced', 'fields' and
+        'records' (a map from record id -> record), or None.
+        '''
+        try:
+            with open(self._Path(base, table)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def Save(self, base, table, fields, records, synced):
+        path = self._Path(base, table)
+        MakePrivateDir(self.path)
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        snapshot = {
+            'synced': synced.isoformat(),
+            'fields': fields,
+            'records': dict((r['id'], r) for r in records),
+        }
+        with open(path + '.tmp', 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(path + '.tmp', path)
+
+def SyncStart():
+    '''
+    Returns the time to record for a sync that is starting now.
+    '''
+    return datetime.datetime.now(datetime.timezone.utc) - SYNC_OVERLAP
+
+def ModifiedSince(synced):
+    '''
+    Returns an Airtable formula matching records modified after synced, an ISO
+    timestamp from a snapshot.
+    '''
+    return "IS_AFTER(LAST_MODIFIED_TIME(), DATETIME_PARSE('%s'))" % synced
@@ -0,0 +1,306 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from sig_groups.airtable import (AirtableClient, RateLimiter, BATCH_SIZE,
+                                  LEADER_FIELDS)
+from sig_groups.ride import Ride, Roster
+from sig_groups.rider import Leader, Participant, RiderData
+from sig_groups.snapshot import SnapshotStore
+
+class _Response(object):
+  def __init__(self, status_code, records=(), offset=None):
+    self.status_code = status_code
+    self.ok = status_code < 400
+    self.content = b''
+    self.records = records
+    self.offset = offset
+
+  def raise_for_status(self):
+    if not self.ok:
+      raise RuntimeError('HTTP %d' % self.status_code)
+
+  def json(self):
+    page = {'records': self.records}
+    if self.offset is not None:
+      page['offset'] = self.offset
+    return page
+
+class _Session(object):
+  '''
+  Records requests and answers them with the next status code queued for the
+  method, or 200.  Creates are answered with new record ids, and lists with
+  pages of page_size records from tables (a map from table -> records), with
+  only the requested fields.  Lists with a formula only return the records
+  whose ids are in modified.
+  '''
+  def __init__(self, statuses=None, tables=None, page_size=100, modified=()):
+    self.statuses = dict((m, list(s)) for (m, s) in (statuses or {}).items())
+    self.tables = tables or {}
+    self.page_size = page_size
+    self.modified = set(modified)
+    self.requests = []
+    self.lock = threading.Lock()
+
+  def request(self, method, url, **kwargs):
+    if kwargs.get('params') is not None:
+      # The client reuses its params across pages.
+      kwargs = dict(kwargs, params=dict(kwargs['params']))
+    with self.lock:
+      self.requests.append((method, kwargs))
+      queued = self.statuses.get(method)
+      status = queued.pop(0) if queued else 200
+      records = []
+      if method == 'POST' and status == 200:
+        first = len(self.requests) * 100
+        records = [{'id': 'new%d' % (first + i)}
+                   for i in range(0, len(kwargs['json']['records']))]
+    if method == 'GET' and status == 200:
+      return self.List(url.split('/')[-1], kwargs['params'])
+    return _Response(status, records)
+
+  def List(self, table, params):
+    records = self.tables.get(table, [])
+    if 'filterByFormula' in params:
+      records = [r for r in records if r['id'] in self.modified]
+    fields = params.get('fields[]')
+    if fields:
+      records = [{'id': r['id'],
+                  'fields': dict((k, v) for (k, v) in r['fields'].items() if k in fields)}
+                 for r in records]
+    start = int(params.get('offset', 0))
+    end = start + min(self.page_size, params['pageSize'])
+    return _Response(200, records[start:end], str(end) if end < len(records) else None)
+
+  def Lists(self):
+    return [kwargs['params'] for (method, kwargs) in self.requests if method == 'GET']
+
+  def Methods(self):
+    return sorted(method for (method, kwargs) in self.requests)
+
+@mock.patch('sig_groups.airtable.time.sleep')
+class WriteRostersTest(unittest.TestCase):
+  def setUp(self):
+    leaders = [Leader('l%d' % i, 'Leader %d' % i) for i in range(0, 2)]
+    participants = [Participant('p%d' % i, 'Participant %d' % i) for i in range(0, 2)]
+    self.riders = RiderData(leaders, participants)
+    config = {'rank': 1, 'title': 'Ride 2', 'airtable_id': 'ride2',
+              'slack_channel': 'ride-2'}
+    self.rides = [Ride(config)]
+    self.client = AirtableClient({'base': 'base', 'key': 'key'}, [config])
+
+  def Rosters(self, count, id=None, finalized=False):
+    return [Roster(self.riders, id and '%s%d' % (id, g), 1, g, ['l0', 'p0', 'l1', 'p1'],
+                   finalized)
+            for g in range(0, count)]
+
+  def testSplitsWritesIntoBatches(self, sleep):
+    self.client.session = _Session()
+    created = self.Rosters(BATCH_SIZE + 1)
+    updated = self.Rosters(3, 'rec')
+    deleted = self.Rosters(BATCH_SIZE, 'old')
+    summary = self.client.WriteRosters(created + updated, deleted, self.rides)
+    self.assertEqual(self.client.session.Methods(),
+                     ['DELETE', 'POST', 'POST', 'PUT'])
+    sizes = {}
+    for (method, kwargs) in self.client.session.requests:
+      if method == 'DELETE':
+        sizes.setdefault(method, []).append(len(kwargs['params']['records[]']))
+      else:
+        sizes.setdefault(method, []).append(len(kwargs['json']['records']))
+    self.assertEqual(sorted(sizes['POST']), [1, BATCH_SIZE])
+    self.assertEqual(sizes['PUT'], [3])
+    self.assertEqual(sizes['DELETE'], [BATCH_SIZE])
+    self.assertEqual(summary, {'create': BATCH_SIZE + 1, 'update': 3,
+                               'delete': BATCH_SIZE, 'failed': 0, 'skipped': 0})
+    # Created rosters get the ids of their new records.
+    self.assertTrue(all(r.id is not None for r in created))
+    self.assertEqual(len(set(r.id for r in created)), len(created))
+
+  def testWritesRecordFields(self, sleep):
+    self.client.session = _Session()
+    self.client.WriteRosters(self.Rosters(1, 'rec'), [], self.rides)
+    ((method, kwargs),) = self.client.session.requests
+    self.assertEqual(method, 'PUT')
+    self.assertEqual(kwargs['json'], {'records': [{'id': 'rec0', 'fields': {
+        'Ride': ['ride2'], 'Group': 0, 'Leaders': ['l0', 'l1'],
+        'Participants': ['p0', 'p1']}}]})
+
+  def testSkipsFinalizedRosters(self, sleep):
+    self.client.session = _Session()
+    summary = self.client.WriteRosters(self.Rosters(2, 'rec', True),
+                                       self.Rosters(1, 'old', True), self.rides)
+    self.assertEqual(self.client.session.requests, [])
+    self.assertEqual(summary['skipped'], 3)
+
+  def testDoesNotResendCreatesOnServerError(self, sleep):
+    self.client.session = _Session({'POST': [503]})
+    created = self.Rosters(1)
+    summary = self.client.WriteRosters(created, [], self.rides)
+    self.assertEqual(self.client.session.Methods(), ['POST'])
+    self.assertEqual(summary['failed'], 1)
+    self.assertIsNone(created[0].id)
+
+  def testRetriesCreatesWhenRateLimited(self, sleep):
+    self.client.session = _Session({'POST': [429]})
+    summary = self.client.WriteRosters(self.Rosters(1), [], self.rides)
+    self.assertEqual(self.client.session.Methods(), ['POST', 'POST'])
+    self.assertEqual(summary['create'], 1)
+
+  def testRetriesUpdatesAndDeletesOnServerError(self, sleep):
+    self.client.session = _Session({'PUT': [500], 'DELETE': [502]})
+    summary = self.client.WriteRosters(self.Rosters(1, 'rec'), self.Rosters(1, 'old'),
+                                       self.rides)
+    self.assertEqual(self.client.session.Methods(), ['DELETE', 'DELETE', 'PUT', 'PUT'])
+    self.assertEqual(summary['failed'], 0)
+
+def _Leader(id, name, **fields):
+  return {'id': id, 'fields': dict({'Name': name, 'Gender': 'F', 'Experience':
+                                    'Experienced Leader', 'Availability': ['Ride 1']},
+                                   **fields)}
+
+@mock.patch('sig_groups.airtable.time.sleep')
+class LoadTest(unittest.TestCase):
+  def setUp(self):
+    config = {'rank': 1, 'title': 'Ride 2', 'airtable_id': 'ride2',
+              'slack_channel': 'ride-2'}
+    self.client = AirtableClient({'base': 'base', 'key': 'key'}, [config])
+    leaders = [_Leader('l%d' % i, 'Leader %d' % i) for i in range(0, 5)]
+    participants = [{'id': 'p0', 'fields': {'Name': 'Participant 0', 'Gender': 'M',
+                                            'Status': 'Progressing'}}]
+    rosters = [{'id': 'rec0', 'fields': {'Ride': ['ride2'], 'Group': 0,
+                                         'Leaders': ['l0', 'l1'],
+                                         'Participants': ['p0'], 'Finalized': True}}]
+    self.tables = {'Leaders': leaders, 'Participants': participants, 'Rosters': rosters}
+
+  def testFollowsOffsets(self, sleep):
+    self.client.session = _Session(tables=self.tables, page_size=2)
+    leaders = self.client.LoadLeaders()
+    self.assertEqual([l.id for l in leaders], ['l0', 'l1', 'l2', 'l3', 'l4'])
+    lists = self.client.session.Lists()
+    self.assertEqual([p.get('offset') for p in lists], [None, '2', '4'])
+    for params in lists:
+      self.assertEqual(params['fields[]'], LEADER_FIELDS)
+
+  def testPrefetchFeedsLoads(self, sleep):
+    self.client.session = _Session(tables=self.tables)
+    self.client.Prefetch()
+    self.assertEqual(len(self.client.session.requests), 3)
+    leaders = self.client.LoadLeaders()
+    participants = self.client.LoadParticipants()
+    rider_data = RiderData(leaders, participants)
+    (roster,) = self.client.GetPriorRosters(rider_data)
+    self.assertEqual(len(self.client.session.requests), 3)
+    self.assertEqual([l.id for l in leaders], ['l0', 'l1', 'l2', 'l3', 'l4'])
+    self.assertEqual(participants[0].status, 'Pr')
+    self.assertEqual((roster.id, roster.ride, roster.group, roster.rider_ids,
+                      roster.finalized), ('rec0', 1, 0, ['l0', 'l1', 'p0'], True))
+    # Prefetched records are only used once.
+    self.client.LoadLeaders()
+    self.assertEqual(len(self.client.session.requests), 4)
+
+@mock.patch('sig_groups.airtable.time.sleep')
+class SyncTableTest(unittest.TestCase):
+  FIELDS = ['Name', 'Gender']
+
+  def setUp(self):
+    self.dir = tempfile.TemporaryDirectory()
+    self.snapshot = SnapshotStore(os.path.join(self.dir.name, 'snapshot'))
+    self.leaders = [_Leader('l%d' % i, 'Leader %d' % i) for i in range(0, 3)]
+
+  def tearDown(self):
+    self.dir.cleanup()
+
+  def Client(self, offline=False, **session):
+    client = AirtableClient({'base': 'base', 'key': 'key'}, [], self.snapshot, offline)
+    client.session = _Session(tables={'Leaders': self.leaders}, **session)
+    return client
+
+  def Sync(self, client, fields=None):
+    return client._SyncTable('Leaders', fields or self.FIELDS)
+
+  def Names(self, records):
+    return [(r['id'], r['fields']['Name']) for r in records]
+
+  def testDownloadsEverythingWithoutASnapshot(self, sleep):
+    client = self.Client()
+    records = self.Sync(client)
+    self.assertEqual(self.Names(records),
+                     [('l0', 'Leader 0'), ('l1', 'Leader 1'), ('l2', 'Leader 2')])
+    (params,) = client.session.Lists()
+    self.assertNotIn('filterByFormula', params)
+    snapshot = self.snapshot.Load('base', 'Leaders')
+    self.assertEqual(snapshot['fields'], self.FIELDS)
+    self.assertEqual(sorted(snapshot['records']), ['l0', 'l1', 'l2'])
+    self.assertEqual(os.stat(self.snapshot.path).st_mode & 0o777, 0o700)
+
+  def testMergesModifiedRecords(self, sleep):
+    self.Sync(self.Client())
+    self.leaders[1] = _Leader('l1', 'Renamed')
+    self.leaders.append(_Leader('l3', 'Leader 3'))
+    client = self.Client(modified=['l1', 'l3'])
+    records = self.Sync(client)
+    self.assertEqual(self.Names(records), [('l0', 'Leader 0'), ('l1', 'Renamed'),
+                                           ('l2', 'Leader 2'), ('l3', 'Leader 3')])
+    (modified, ids) = client.session.Lists()
+    self.assertIn('filterByFormula', modified)
+    self.assertEqual(modified['fields[]'], self.FIELDS)
+    self.assertEqual(ids['fields[]'], self.FIELDS[:1])
+    self.assertEqual(self.Names(self.Sync(self.Client(offline=True))), self.Names(records))
+
+  def testDropsDeletedRecords(self, sleep):
+    self.Sync(self.Client())
+    del self.leaders[0]
+    records = self.Sync(self.Client())
+    self.assertEqual([r['id'] for r in records], ['l1', 'l2'])
+    self.assertEqual(sorted(self.snapshot.Load('base', 'Leaders')['records']),
+                     ['l1', 'l2'])
+
+  def testDownloadsEverythingWhenFieldsChange(self, sleep):
+    self.Sync(self.Client())
+    client = self.Client()
+    records = self.Sync(client, self.FIELDS + ['Experience'])
+    (params,) = client.session.Lists()
+    self.assertNotIn('filterByFormula', params)
+    self.assertEqual(records[0]['fields']['Experience'], 'Experienced Leader')
+    self.assertEqual(self.snapshot.Load('base', 'Leaders')['fields'],
+                     self.FIELDS + ['Experience'])
+
+  def testOfflineReadsTheSnapshot(self, sleep):
+    self.Sync(self.Client())
+    client = self.Client(offline=True)
+    records = self.Sync(client)
+    self.assertEqual([r['id'] for r in records], ['l0', 'l1', 'l2'])
+    self.assertEqual(client.session.requests, [])
+
+  def testOfflineWithoutASnapshot(self, sleep):
+    client = self.Client(offline=True)
+    with self.assertRaises(RuntimeError):
+      self.Sync(client)
+    self.assertEqual(client.session.requests, [])
+    with self.assertRaises(ValueError):
+      AirtableClient({'base': 'base', 'key': 'key'}, [], None, True)
+
+class RateLimiterTest(unittest.TestCase):
+  def testSpacesRequests(self):
+    clock = [100.0]
+    sleeps = []
+    def Sleep(seconds):
+      sleeps.append(seconds)
+      clock[0] += seconds
+    with mock.patch('sig_groups.airtable.time.monotonic', lambda: clock[0]), \
+         mock.patch('sig_groups.airtable.time.sleep', Sleep):
+      limiter = RateLimiter(5)
+      for i in range(0, 3):
+        limiter.Wait()
+      self.assertEqual(len(sleeps), 2)
+      self.assertAlmostEqual(clock[0], 100.4)
+      # After an idle period requests go out right away.
+      clock[0] += 10
+      limiter.Wait()
+      self.assertEqual(len(sleeps), 2)
+
+if __name__ == '__main__':
+  unittest.main()
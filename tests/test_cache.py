@@ -0,0 +1,51 @@
+import os
+import stat
+import tempfile
+import unittest
+
+import numpy as np
+
+from sig_groups.cache import SolveCache
+
+class SolveCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.TemporaryDirectory()
+    self.cache = SolveCache(os.path.join(self.dir.name, 'solves'), max_entries=2)
+
+  def tearDown(self):
+    self.dir.cleanup()
+
+  def testRoundTripsHints(self):
+    hints = {'memberships': np.array([[[1, 0, -1]]], dtype=np.int8),
+             'group_active': {(0, 0): 1, (0, 1): 0},
+             'num_groups': {0: 1}}
+    self.cache.Put('groups-a', hints)
+    value = self.cache.Get('groups-a')
+    self.assertEqual(value['memberships'].dtype, np.int8)
+    np.testing.assert_array_equal(value['memberships'], hints['memberships'])
+    self.assertEqual(value['group_active'], hints['group_active'])
+    self.assertEqual(value['num_groups'], hints['num_groups'])
+
+  def testRoundTripsMemberships(self):
+    memberships = [(0, 1, 'rec1'), (2, 0, 'rec2')]
+    self.cache.Put('pairings-a', memberships)
+    self.assertEqual(self.cache.Get('pairings-a'), memberships)
+
+  def testMissingKey(self):
+    self.assertIsNone(self.cache.Get('pairings-missing'))
+
+  def testDirectoryIsPrivate(self):
+    self.cache.Put('pairings-a', [])
+    mode = stat.S_IMODE(os.stat(self.cache.path).st_mode)
+    self.assertEqual(mode, 0o700)
+
+  def testEvictsArrays(self):
+    for key in ('a', 'b', 'c'):
+      self.cache.Put(key, {'memberships': np.zeros((1, 1, 1), dtype=np.int8)})
+      os.utime(self.cache._Path(key), (0, {'a': 1, 'b': 2, 'c': 3}[key]))
+    self.cache.Put('d', [])
+    self.assertEqual(sorted(os.listdir(self.cache.path)),
+                     ['c.json', 'c.npz', 'd.json'])
+
+if __name__ == '__main__':
+  unittest.main()
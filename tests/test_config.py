@@ -0,0 +1,21 @@
+import unittest
+
+from sig_groups.config import Config
+
+class SolverProfileTest(unittest.TestCase):
+  def testPassProfileOverridesShared(self):
+    config = Config({'algorithm': {'solver': {'num_workers': 8, 'random_seed': 1},
+                                   'pairings_solver': {'num_workers': 2}}})
+    self.assertEqual(config.SolverProfile('group_size'),
+                     {'num_workers': 8, 'random_seed': 1})
+    self.assertEqual(config.SolverProfile('pairings'),
+                     {'num_workers': 2, 'random_seed': 1})
+
+  def testRejectsUnknownParameters(self):
+    config = Config({'algorithm': {'pairings_solver': {'num_worker': 2}}})
+    self.assertEqual(config.SolverProfile('group_size'), {})
+    with self.assertRaisesRegex(ValueError, 'num_worker'):
+      config.SolverProfile('pairings')
+
+if __name__ == '__main__':
+  unittest.main()
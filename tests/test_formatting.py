@@ -0,0 +1,76 @@
+import unittest
+
+import numpy as np
+
+from sig_groups.config import Config
+from sig_groups.formatting import _Frames
+from sig_groups.ride import Roster
+from sig_groups.rider import Leader, Participant, RiderData
+
+class FramesTest(unittest.TestCase):
+  '''
+  Checks the heatmap matrices against counts worked out by hand.  Riders are
+  plotted by decreasing availability: l0, l1, p0, p1.
+  '''
+  def setUp(self):
+    availability = {'l0': 3, 'l1': 3, 'p0': 2, 'p1': 1, 'p2': 0}
+    leaders = [Leader('l0', 'Leader 0'), Leader('l1', 'Leader 1')]
+    participants = [Participant('p%d' % i, 'Participant %d' % i) for i in range(0, 3)]
+    for p in leaders + participants:
+      for r in range(0, availability[p.id]):
+        p.SetAvailable(r)
+    self.riders = RiderData(leaders, participants)
+    self.config = Config({'rides': [{}, {}, {}], 'algorithm': {'start_ride': 1}})
+
+  def testPairMatrices(self):
+    rosters = [
+        # l0 is listed twice, p2 isn't available for any ride and ghost isn't
+        # a rider, so neither is plotted.
+        Roster(self.riders, 'a', 0, 0, ['l0', 'p0', 'l0', 'ghost'], True),
+        Roster(self.riders, 'b', 0, 1, ['l1', 'p1', 'p2'], True),
+        Roster(self.riders, 'c', 1, 0, ['l0', 'l1']),
+        Roster(self.riders, 'd', 1, 1, ['p0']),
+        Roster(self.riders, 'e', 2, 0, ['l0', 'p0', 'l1']),
+    ]
+    frames = _Frames(self.config, rosters, self.riders)
+    self.assertEqual([f[2] for f in frames],
+                     [['Leader 0', 'Leader 1', 'Participant 0', 'Participant 1']] * 3)
+    self.assertEqual([f[3:] for f in frames], [(0, 3, True), (1, 3, False), (2, 3, False)])
+
+    # Above the diagonal: rides together through each ride.  On and below it:
+    # through the last ride, with the diagonal counting each rider's rides.
+    last = [[3, 0, 0, 0],
+            [2, 3, 0, 0],
+            [2, 1, 3, 0],
+            [0, 1, 0, 1]]
+    modeled = [[[0, 0, 1, 0],
+                [0, 0, 0, 1],
+                [0, 0, 0, 0],
+                [0, 0, 0, 0]],
+               [[0, 1, 1, 0],
+                [0, 0, 0, 1],
+                [0, 0, 0, 0],
+                [0, 0, 0, 0]],
+               [[0, 2, 2, 0],
+                [0, 0, 1, 1],
+                [0, 0, 0, 0],
+                [0, 0, 0, 0]]]
+    new = [[[0, 0, 1, 0],
+            [0, 0, 0, 1],
+            [0, 0, 0, 0],
+            [0, 0, 0, 0]],
+           [[0, 1, 0, 0],
+            [0, 0, 0, 0],
+            [0, 0, 0, 0],
+            [0, 0, 0, 0]],
+           [[0, 1, 1, 0],
+            [0, 0, 1, 0],
+            [0, 0, 0, 0],
+            [0, 0, 0, 0]]]
+    for (ride, frame) in enumerate(frames):
+      with self.subTest(ride=ride):
+        np.testing.assert_array_equal(frame[0], np.array(modeled[ride]) + np.array(last))
+        np.testing.assert_array_equal(frame[1], new[ride])
+
+if __name__ == '__main__':
+  unittest.main()
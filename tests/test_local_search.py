@@ -0,0 +1,113 @@
+import contextlib
+import io
+import unittest
+
+from ortools.sat.python import cp_model
+
+from sig_groups.benchmark.instances import InstanceSpec, Generate
+from sig_groups.local_search import LocalSearch
+from sig_groups.optimizer import AlgorithmTM, Params, SolutionValues, Vars
+
+class _Solutions(cp_model.CpSolverSolutionCallback):
+  '''
+  Records the memberships of the first limit solutions found.
+  '''
+  def __init__(self, vars, limit):
+    cp_model.CpSolverSolutionCallback.__init__(self)
+    self.vars = vars
+    self.limit = limit
+    self.memberships = []
+    self.hints = []
+
+  def on_solution_callback(self):
+    values = SolutionValues(self.Response())
+    self.memberships.append(self.vars.SelectedMemberships(values))
+    self.hints.append(self.vars.MembershipHints(values))
+    if len(self.memberships) >= self.limit:
+      self.StopSearch()
+
+def _Solver():
+  '''
+  Returns a single threaded solver with a deterministic time limit, so that
+  the solutions found don't depend on the speed of the machine.
+  '''
+  solver = cp_model.CpSolver()
+  solver.parameters.num_workers = 1
+  solver.parameters.random_seed = 0
+  solver.parameters.max_deterministic_time = 10
+  return solver
+
+class LocalSearchScoreTest(unittest.TestCase):
+  '''
+  LocalSearch hill climbs on Score(), so it must rank rosters the same as the
+  pass 2 objective: the two can only differ by a constant for an instance.
+  '''
+  def Setup(self, seed, lookahead_rides):
+    spec = InstanceSpec('test', 10, 16, 5, seed=seed, finalized_rides=1)
+    instance = Generate(spec)
+    # An ignored rider, whose pairs are free in the model.
+    instance.rider_data.AllLeaders()[0].part_time = True
+    params = Params()
+    params.num_rides = spec.num_rides - lookahead_rides
+    params.lookahead_rides = lookahead_rides
+    params.start_ride = spec.finalized_rides
+    params.finalized_ride = spec.finalized_rides - 1
+    return (instance, params)
+
+  def Solve(self, alg):
+    '''
+    Returns the pass 1 hints and the _Solutions of pass 2.
+    '''
+    vars = Vars()
+    model = alg.BuildBaseModel(vars)
+    alg.OptimizeGroupSize(model, vars)
+    solver = _Solver()
+    solver.parameters.stop_after_first_solution = True
+    self.assertIn(solver.Solve(model), (cp_model.OPTIMAL, cp_model.FEASIBLE))
+    hints = vars.RecordHints(solver)
+
+    vars = Vars()
+    model = alg.BuildBaseModel(vars)
+    vars.RestoreHints(model, hints)
+    alg.OptimizePairings(model, vars)
+    solutions = _Solutions(vars, 3)
+    _Solver().Solve(model, solutions)
+    return (hints, solutions)
+
+  def Objective(self, alg, memberships):
+    '''
+    Returns the pass 2 objective with the memberships fixed.
+    '''
+    vars = Vars()
+    model = alg.BuildBaseModel(vars)
+    vars.FixMemberships(model, memberships)
+    alg.OptimizePairings(model, vars)
+    solver = _Solver()
+    self.assertEqual(solver.Solve(model), cp_model.OPTIMAL)
+    return int(solver.ObjectiveValue())
+
+  def CheckScoreMatchesObjective(self, seed, lookahead_rides):
+    (instance, params) = self.Setup(seed, lookahead_rides)
+    with contextlib.redirect_stdout(io.StringIO()):
+      alg = AlgorithmTM(instance.rider_data, instance.rides, instance.prior_rosters, params)
+      (hints, solutions) = self.Solve(alg)
+      self.assertGreater(len(solutions.memberships), 1)
+      differences = set()
+      for (memberships, values) in zip(solutions.memberships, solutions.hints):
+        search = LocalSearch(alg, dict(hints, memberships=values))
+        self.assertEqual(search.Violations(), 0)
+        differences.add(search.Score() - self.Objective(alg, memberships))
+    self.assertEqual(len(differences), 1, differences)
+
+  def testScoreMatchesObjective(self):
+    for seed in (1, 2, 3):
+      with self.subTest(seed=seed):
+        self.CheckScoreMatchesObjective(seed, 0)
+
+  def testScoreMatchesObjectiveWithLookahead(self):
+    for seed in (1, 2, 3):
+      with self.subTest(seed=seed):
+        self.CheckScoreMatchesObjective(seed, 2)
+
+if __name__ == '__main__':
+  unittest.main()
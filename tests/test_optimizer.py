@@ -0,0 +1,137 @@
+import contextlib
+import copy
+import io
+import unittest
+
+from ortools.sat.python import cp_model
+
+from sig_groups.benchmark.instances import InstanceSpec, Generate
+from sig_groups.optimizer import AlgorithmTM, Params, SolutionValues, Vars
+
+class _Solutions(cp_model.CpSolverSolutionCallback):
+  '''
+  Records the memberships of the first limit solutions found.
+  '''
+  def __init__(self, vars, limit):
+    cp_model.CpSolverSolutionCallback.__init__(self)
+    self.vars = vars
+    self.limit = limit
+    self.memberships = []
+
+  def on_solution_callback(self):
+    self.memberships.append(self.vars.SelectedMemberships(SolutionValues(self.Response())))
+    if len(self.memberships) >= self.limit:
+      self.StopSearch()
+
+def _Solver():
+  '''
+  Returns a single threaded solver with a deterministic time limit, so that
+  the solutions found don't depend on the speed of the machine.
+  '''
+  solver = cp_model.CpSolver()
+  solver.parameters.num_workers = 1
+  solver.parameters.random_seed = 0
+  solver.parameters.max_deterministic_time = 10
+  return solver
+
+def _Setup(spec):
+  instance = Generate(spec)
+  params = Params()
+  params.num_rides = spec.num_rides
+  params.start_ride = spec.finalized_rides
+  params.finalized_ride = spec.finalized_rides - 1
+  return (instance, params)
+
+def _Algorithm(instance, params):
+  with contextlib.redirect_stdout(io.StringIO()):
+    return AlgorithmTM(instance.rider_data, instance.rides, instance.prior_rosters, params)
+
+class FormulationTest(unittest.TestCase):
+  '''
+  Sparse and dense memberships and the two pairing encodings fold or model the
+  finalized rides differently, but must rank rosters the same: on the same
+  fixed rosters their pass 2 objectives can only differ by a constant.
+  '''
+  FORMULATIONS = [(True, 'assignment'), (False, 'membership'), (False, 'assignment')]
+
+  def Solutions(self, alg):
+    '''
+    Returns the memberships of a few pass 2 solutions.
+    '''
+    vars = Vars()
+    model = alg.BuildBaseModel(vars)
+    alg.OptimizeGroupSize(model, vars)
+    solver = _Solver()
+    solver.parameters.stop_after_first_solution = True
+    self.assertIn(solver.Solve(model), (cp_model.OPTIMAL, cp_model.FEASIBLE))
+    hints = vars.RecordHints(solver)
+
+    vars = Vars()
+    model = alg.BuildBaseModel(vars)
+    vars.RestoreHints(model, hints)
+    with contextlib.redirect_stdout(io.StringIO()):
+      alg.OptimizePairings(model, vars)
+    solutions = _Solutions(vars, 3)
+    _Solver().Solve(model, solutions)
+    self.assertGreater(len(solutions.memberships), 1)
+    return solutions.memberships
+
+  def Objective(self, alg, memberships):
+    '''
+    Returns the pass 2 objective with the memberships fixed.
+    '''
+    vars = Vars()
+    model = alg.BuildBaseModel(vars)
+    vars.FixMemberships(model, memberships)
+    with contextlib.redirect_stdout(io.StringIO()):
+      alg.OptimizePairings(model, vars)
+    solver = _Solver()
+    self.assertEqual(solver.Solve(model), cp_model.OPTIMAL)
+    return int(solver.ObjectiveValue())
+
+  def CheckFormulationsAgree(self, seed):
+    (instance, params) = _Setup(InstanceSpec('test', 10, 16, 5, seed=seed,
+                                             finalized_rides=2))
+    alg = _Algorithm(instance, params)
+    solutions = self.Solutions(alg)
+    objectives = [self.Objective(alg, memberships) for memberships in solutions]
+    for (sparse, encoding) in self.FORMULATIONS:
+      formulation = copy.copy(params)
+      formulation.sparse_memberships = sparse
+      formulation.pairing_encoding = encoding
+      alg = _Algorithm(instance, formulation)
+      differences = set(self.Objective(alg, memberships) - objective
+                        for (memberships, objective) in zip(solutions, objectives))
+      self.assertEqual(len(differences), 1, (sparse, encoding, differences))
+
+  def testFormulationsAgree(self):
+    for seed in (1, 2):
+      with self.subTest(seed=seed):
+        self.CheckFormulationsAgree(seed)
+
+class SymmetryBreakingTest(unittest.TestCase):
+  '''
+  Symmetry breaking only removes reorderings of the groups on a ride, so it
+  must leave the pass 1 optimum unchanged.
+  '''
+  def Optimum(self, instance, params):
+    alg = _Algorithm(instance, params)
+    vars = Vars()
+    model = alg.BuildBaseModel(vars)
+    alg.OptimizeGroupSize(model, vars)
+    solver = _Solver()
+    self.assertEqual(solver.Solve(model), cp_model.OPTIMAL)
+    return solver.ObjectiveValue()
+
+  def testKeepsGroupSizeOptimum(self):
+    for seed in (1, 2, 3):
+      with self.subTest(seed=seed):
+        (instance, params) = _Setup(InstanceSpec('test', 8, 12, 3, seed=seed,
+                                                 finalized_rides=1))
+        symmetry_breaking = copy.copy(params)
+        symmetry_breaking.symmetry_breaking = True
+        self.assertEqual(self.Optimum(instance, params),
+                         self.Optimum(instance, symmetry_breaking))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+
+from sig_groups.ride import Roster, RosterDiff
+from sig_groups.rider import Leader, Participant, RiderData
+
+def _RiderData():
+  leaders = [Leader('l%d' % i, 'Leader %d' % i) for i in range(0, 4)]
+  participants = [Participant('p%d' % i, 'Participant %d' % i) for i in range(0, 4)]
+  return RiderData(leaders, participants)
+
+class RosterDiffTest(unittest.TestCase):
+  def setUp(self):
+    self.riders = _RiderData()
+
+  def Roster(self, id, ride, group, rider_ids, finalized=False):
+    return Roster(self.riders, id, ride, group, rider_ids, finalized)
+
+  def testClassifiesRosters(self):
+    prior = [self.Roster('rec1', 1, 0, ['l0', 'p0']),
+             self.Roster('rec2', 1, 1, ['l1', 'p1']),
+             self.Roster('rec3', 2, 0, ['l0', 'p0']),
+             self.Roster('rec4', 2, 1, ['l1', 'p1'])]
+    new = [self.Roster('rec1', 1, 0, ['p0', 'l0']),  # same riders, reordered
+           self.Roster('rec2', 1, 1, ['l1', 'p2']),
+           self.Roster('rec3', 2, 0, ['l0', 'p0']),
+           self.Roster(None, 2, 2, ['l2', 'p2'])]
+    diff = RosterDiff(new, prior, range(1, 3))
+    self.assertEqual([r.id for r in diff.unchanged], ['rec1', 'rec3'])
+    self.assertEqual([r.id for r in diff.changed], ['rec2'])
+    self.assertEqual([(r.ride, r.group) for r in diff.added], [(2, 2)])
+    self.assertEqual([r.id for r in diff.removed], ['rec4'])
+    self.assertEqual(diff.Writes(), diff.added + diff.changed)
+    self.assertEqual(diff.ChangedRides(), [1, 2])
+
+  def testIgnoresRidesOutsideRange(self):
+    prior = [self.Roster('rec1', 0, 0, ['l0', 'p0'], True),
+             self.Roster('rec2', 3, 0, ['l0', 'p0'])]
+    new = [self.Roster('rec1', 0, 0, ['l1', 'p1'], True),
+           self.Roster(None, 4, 0, ['l0', 'p0'])]
+    diff = RosterDiff(new, prior, range(1, 3))
+    self.assertEqual(diff.Writes(), [])
+    self.assertEqual(diff.removed, [])
+    self.assertEqual(diff.ChangedRides(), [])
+
+  def testUnchangedRostersAreNotWritten(self):
+    prior = [self.Roster('rec1', 1, 0, ['l0', 'p0'])]
+    new = [self.Roster('rec1', 1, 0, ['l0', 'p0'])]
+    diff = RosterDiff(new, prior, [1])
+    self.assertEqual(diff.Writes(), [])
+    self.assertEqual(diff.ChangedRides(), [])
+
+if __name__ == '__main__':
+  unittest.main()